@@ -0,0 +1,130 @@
+"""Throughput of pub_blend's AU --> blendshape conversion, per message vs batched, for a growing number of streams
+
+Every stream replays the AU values of a cleaned OpenFace csv; frames of all streams arrive together (1 tick),
+as with several participants published at the same frame rate. No ZeroMQ sockets are used.
+
+Batching gives a small, run-dependent gain (~1-1.5x): per message json.dumps and printing take most of the time,
+not the matrix product, so pub_blend converts every message on its own unless --batch_max is given."""
+
+# Copyright (c) Stef van der Struijk
+# License: GNU Lesser General Public License
+
+
+import os
+import sys
+import argparse
+import json
+import time
+import asyncio
+import contextlib
+import pandas as pd
+
+
+# FACSvatar imports; if statement for documentation
+if __name__ == '__main__':
+    sys.path.append("../..")
+    from modules.process_facstoblend.pub_blend import FACSvatarMessages
+else:
+    from modules.process_facstoblend.pub_blend import FACSvatarMessages
+
+
+# AU_json / mapping_cache are relative to process_facstoblend
+BLEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "process_facstoblend")
+
+
+# counts published messages instead of sending them
+class NullSocket:
+    def __init__(self):
+        self.msg_count = 0
+
+    async def send_multipart(self, msg):
+        self.msg_count += 1
+
+
+# messages as pub_facs would publish them
+def csv_frames(csv_path):
+    df = pd.read_csv(csv_path)
+    au_cols = [col for col in df.columns if col.startswith("AU") and col.endswith("_r")]
+    pose_cols = [col for col in df.columns if col.startswith("pose_R")]
+
+    frames = []
+    for row in df.itertuples(index=False):
+        row = row._asdict()
+        frames.append({'confidence': row.get('confidence', 1.0), 'frame': int(row['frame']),
+                       'timestamp': row['timestamp'],
+                       'au_r': {col[:-2]: row[col] for col in au_cols},
+                       'pose': {col: row[col] for col in pose_cols}})
+
+    return frames
+
+
+# ticks of messages; every tick 1 frame of every stream
+def stream_ticks(frames, streams, tick_count):
+    ticks = []
+    for t in range(tick_count):
+        data = json.dumps(frames[t % len(frames)]).encode('utf-8')
+        ticks.append([["facs.p{}.bench".format(k).encode('ascii'), str(t).encode('ascii'), data]
+                      for k in range(streams)])
+
+    return ticks
+
+
+# seconds to convert and publish all ticks; batch_max 1: 1 message per conversion
+def time_ticks(facsvatar_messages, ticks, batch_max):
+    async def run():
+        for tick in ticks:
+            # pass copies; conversion changes messages
+            tick = [list(msg) for msg in tick]
+            for i in range(0, len(tick), batch_max):
+                await facsvatar_messages.blendshape_msgs(tick[i:i + batch_max])
+
+    # per message printing is not part of the measurement
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        time_start = time.perf_counter()
+        asyncio.run(run())
+
+        return time.perf_counter() - time_start
+
+
+def main(csv_path, streams_list, tick_count, batch_max):
+    frames = csv_frames(csv_path)
+
+    # mapping files and cache relative to process_facstoblend
+    os.chdir(BLEND_DIR)
+    facsvatar_messages = FACSvatarMessages()
+    facsvatar_messages.pub_socket = NullSocket()
+
+    print("\n{:>8} {:>14} {:>14} {:>8}".format("streams", "single msg/s", "batch msg/s", "speedup"))
+    results = []
+    for streams in streams_list:
+        ticks = stream_ticks(frames, streams, tick_count)
+        msg_count = streams * tick_count
+
+        time_single = time_ticks(facsvatar_messages, ticks, 1)
+        time_batch = time_ticks(facsvatar_messages, ticks, batch_max)
+
+        results.append({'streams': streams, 'single_msg_s': msg_count / time_single,
+                        'batch_msg_s': msg_count / time_batch, 'speedup': time_single / time_batch})
+        print("{streams:>8} {single_msg_s:>14.0f} {batch_msg_s:>14.0f} {speedup:>7.2f}x".format(**results[-1]))
+
+    return results
+
+
+if __name__ == '__main__':
+    # command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv", default="../input_facsfromcsv/openface/default_clean/demo.csv",
+                        help="Cleaned OpenFace csv used for AU values; Default: demo.csv")
+    parser.add_argument("--streams", default="1,2,4,8,16,32,64",
+                        help="Comma separated number of concurrent streams; Default: 1,2,4,8,16,32,64")
+    parser.add_argument("--ticks", default="200",
+                        help="Frames per stream; Default: 200")
+    parser.add_argument("--batch_max", default="32",
+                        help="Max messages converted together (as pub_blend --batch_max); Default: 32")
+
+    args, leftovers = parser.parse_known_args()
+    print("The following arguments are used: {}".format(args))
+    print("The following arguments are ignored: {}\n".format(leftovers))
+
+    main(os.path.abspath(args.csv), [int(s) for s in args.streams.split(",")], int(args.ticks),
+         int(args.batch_max))
@@ -0,0 +1,332 @@
+"""Micro-benchmarks of the per-frame stages of the FACSvatar pipeline
+
+Stages are driven with the bundled default_clean csv files, repeated x times (--scale) for larger inputs.
+Per stage: latency per call (percentiles), throughput and memory allocated per call (tracemalloc).
+Results are written as JSON; 2 result files (e.g. before and after a commit) can be compared with --compare.
+
+Stages needing an unavailable dependency (e.g. Keras for the DNN) are reported as skipped."""
+
+# Copyright (c) Stef van der Struijk
+# License: GNU Lesser General Public License
+
+
+import os
+import sys
+import argparse
+import json
+import time
+import platform
+import subprocess
+import statistics
+import tempfile
+import tracemalloc
+import asyncio
+import contextlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+# FACSvatar imports with 'modules.' prefix
+if __name__ == '__main__':
+    sys.path.append("../..")
+
+MODULES_DIR = Path(__file__).resolve().parents[1]
+CSV_DIR = MODULES_DIR / "input_facsfromcsv" / "openface" / "default_clean"
+
+
+# run in a folder (relative data paths of modules); stdout hidden, modules print every frame
+@contextlib.contextmanager
+def quiet_in(folder):
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        os.chdir(cwd)
+
+
+# cleaned csv files repeated scale times; frames and timestamps continue
+def load_csvs(csv_dir, scale):
+    df_list = []
+    for csv_path in sorted(csv_dir.glob("*.csv")):
+        df = pd.read_csv(csv_path)
+        duration = df['timestamp'].iloc[-1] + df['timestamp'].diff().median()
+        df = pd.concat([df.assign(timestamp=df['timestamp'] + i * duration) for i in range(scale)],
+                       ignore_index=True)
+        df['frame'] = df.index
+        df_list.append((csv_path.name, df))
+
+    return df_list
+
+
+# messages (as sent by pub_facs) of every row
+def csv_msgs(df_list):
+    from modules.input_facsfromcsv.pub_facs import OpenFaceMessage
+
+    msgs = []
+    ofmsg = OpenFaceMessage()
+    for _, df in df_list:
+        for row in df.to_dict('records'):
+            ofmsg.set_msg_row(row)
+            if 'au_r' in ofmsg.msg:
+                msgs.append(ofmsg.msg)
+
+    return msgs
+
+
+# raw OpenFace csv files (header with spaces, AU 0-5, frames from 1) to clean
+def write_raw_csvs(df_list, raw_dir):
+    raw_paths = []
+    for name, df in df_list:
+        df = df.copy()
+        au_cols = df.columns.str.contains("AU.*_r")
+        df.loc[:, au_cols] *= 5
+        df['frame'] += 1
+        df.columns = [col if col == 'frame' else " " + col for col in df.columns]
+
+        raw_path = raw_dir / name
+        df.to_csv(raw_path, index=False)
+        raw_paths.append((raw_path, len(df)))
+
+    return raw_paths
+
+
+#   stages; every setup returns (function, list of argument tuples, items (e.g. rows) per call)
+
+def setup_smooth(ctx):
+    from modules.smooth_data import SmoothData
+
+    au_list = [dict(sorted(msg['au_r'].items())) for msg in ctx['msgs']]
+    with quiet_in(MODULES_DIR):
+        smooth_data = SmoothData()
+        smooth_data.set_new_multiplier(len(au_list[0]))
+
+    # window and steepness as used by n_proxy_m_bus
+    def run(au_dict):
+        return smooth_data.trailing_moving_average(au_dict, queue_no=0, window_size=3, steep=.25)
+
+    return run, [(au_dict,) for au_dict in au_list], 1
+
+
+def setup_blendshapes(ctx):
+    from modules.process_facstoblend.au2blendshapes_mb import AUtoBlendShapes
+
+    with quiet_in(MODULES_DIR / "process_facstoblend"):
+        au_to_blendshapes = AUtoBlendShapes()
+
+    return au_to_blendshapes.output_blendshapes, [(msg['au_r'],) for msg in ctx['msgs']], 1
+
+
+def setup_set_msg(ctx):
+    from modules.input_facsfromcsv.pub_facs import OpenFaceMessage
+
+    args = []
+    for _, df in ctx['df_list']:
+        ofmsg = OpenFaceMessage()
+        ofmsg.set_df(df)
+        ofmsg.df_split()
+        args += [(ofmsg, frame) for frame in range(len(df))]
+
+    def run(ofmsg, frame):
+        ofmsg.set_msg(frame)
+        return ofmsg.msg
+
+    return run, args, 1
+
+
+def setup_clean(ctx):
+    from modules.input_facsfromcsv.openfacefiltercsv import FilterCSV
+
+    raw_dir = ctx['tmp_dir'] / "raw"
+    raw_dir.mkdir(exist_ok=True)
+    clean_dir = ctx['tmp_dir'] / "clean"
+    raw_paths = write_raw_csvs(ctx['df_list'], raw_dir)
+
+    filter_csv = FilterCSV(chunk_size=ctx['chunk_size'])
+
+    # rows per call differ per file; average for throughput
+    return filter_csv.clean_controller, [(raw_path, clean_dir) for raw_path, _ in raw_paths], \
+        statistics.mean(rows for _, rows in raw_paths)
+
+
+def setup_gaze(ctx):
+    from modules.n_proxy_m_bus import FACSvatarMessages
+
+    # method doesn't use its instance; call unbound instead of setting-up sockets
+    def run(au_dict, gaze):
+        return FACSvatarMessages.gaze_to_au(None, au_dict, gaze)
+
+    return run, [(dict(msg['au_r']), msg['gaze']) for msg in ctx['msgs'] if 'gaze' in msg], 1
+
+
+def setup_deepfacs(ctx):
+    from modules.process_facsdnnfacs.pub_deepfacs import DeepFACSMsg
+
+    with quiet_in(MODULES_DIR / "process_facsdnnfacs"):
+        deep_facs_msg = DeepFACSMsg()
+    loop = asyncio.new_event_loop()
+
+    def run(au_dict):
+        return loop.run_until_complete(deep_facs_msg.facs_deep_facs(dict(au_dict)))
+
+    return run, [(msg['au_r'],) for msg in ctx['msgs']], 1
+
+
+STAGES = {
+    'smooth_data.trailing_moving_average': setup_smooth,
+    'au2blendshapes_mb.output_blendshapes': setup_blendshapes,
+    'pub_facs.set_msg': setup_set_msg,
+    'openfacefiltercsv.clean_controller': setup_clean,
+    'n_proxy_m_bus.gaze_to_au': setup_gaze,
+    'pub_deepfacs.facs_deep_facs': setup_deepfacs,
+}
+
+
+# latency, throughput and allocations of calling func once per argument tuple
+def measure(func, args, items_per_call, calls, warmup, alloc_calls):
+    calls = calls or len(args)
+
+    for i in range(min(warmup, calls)):
+        func(*args[i % len(args)])
+
+    latency = []
+    time_start = time.perf_counter()
+    for i in range(calls):
+        t = time.perf_counter()
+        func(*args[i % len(args)])
+        latency.append(time.perf_counter() - t)
+    time_total = time.perf_counter() - time_start
+
+    # memory allocated during a call (peak) and still allocated after it (retained)
+    alloc_peak = []
+    alloc_retained = []
+    for i in range(min(alloc_calls, calls)):
+        tracemalloc.start()
+        func(*args[i % len(args)])
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        alloc_peak.append(peak)
+        alloc_retained.append(retained)
+
+    latency_us = np.array(latency) * 1e6
+    return {'calls': calls,
+            'latency_us': {'mean': float(latency_us.mean()),
+                           **{"p{}".format(p): float(np.percentile(latency_us, p)) for p in (50, 90, 99)},
+                           'max': float(latency_us.max())},
+            'calls_per_s': calls / time_total,
+            'items_per_s': calls * items_per_call / time_total,
+            'alloc_peak_kib': statistics.median(alloc_peak) / 1024,
+            'alloc_retained_kib': statistics.median(alloc_retained) / 1024,
+            }
+
+
+def run_stages(stage_names, scale, calls, warmup, alloc_calls, chunk_size):
+    df_list = load_csvs(CSV_DIR, scale)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ctx = {'df_list': df_list, 'msgs': csv_msgs(df_list), 'tmp_dir': Path(tmp_dir), 'chunk_size': chunk_size}
+
+        for name in stage_names:
+            print("Stage: {}".format(name))
+            try:
+                func, args, items_per_call = STAGES[name](ctx)
+            except (ImportError, OSError) as e:
+                print("    skipped: {}".format(e))
+                results[name] = {'skipped': str(e)}
+                continue
+
+            # clean_controller: every call processes a whole file
+            stage_calls = len(args) if name.endswith("clean_controller") else calls
+            with quiet_in(MODULES_DIR):
+                results[name] = measure(func, args, items_per_call, stage_calls, warmup, alloc_calls)
+            print("    p50 {p50:.1f} us, p99 {p99:.1f} us".format(**results[name]['latency_us']) +
+                  ", {calls_per_s:.0f} calls/s, peak {alloc_peak_kib:.1f} KiB".format(**results[name]))
+
+    return results
+
+
+# commit of the measured code, if in a git repository
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=str(MODULES_DIR),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# compare 2 result files; returns stages slower than threshold (fraction)
+def compare(path_old, path_new, threshold):
+    with open(path_old) as f:
+        old = json.load(f)
+    with open(path_new) as f:
+        new = json.load(f)
+
+    print("{} ({}) --> {} ({})\n".format(path_old, old['meta']['commit'], path_new, new['meta']['commit']))
+    print("{:<40} {:>10} {:>10} {:>8} {:>10} {:>10}".format("stage", "p50 old", "p50 new", "change",
+                                                          "peak old", "peak new"))
+
+    regressions = []
+    for name, stage_new in new['stages'].items():
+        stage_old = old['stages'].get(name)
+        if not stage_old or 'skipped' in stage_old or 'skipped' in stage_new:
+            print("{:<40} {:>10}".format(name, "skipped"))
+            continue
+
+        p50_old = stage_old['latency_us']['p50']
+        p50_new = stage_new['latency_us']['p50']
+        change = p50_new / p50_old - 1
+        flag = " <-- slower" if change > threshold else ""
+        if flag:
+            regressions.append(name)
+        print("{:<40} {:>8.1f}us {:>8.1f}us {:>+7.1%} {:>7.1f}KiB {:>7.1f}KiB{}".format(
+            name, p50_old, p50_new, change, stage_old['alloc_peak_kib'], stage_new['alloc_peak_kib'], flag))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    # command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", default="",
+                        help="Comma separated stage names (or part of them); Default: '' (all)")
+    parser.add_argument("--scale", default="1",
+                        help="Repeat bundled csv data x times for larger inputs; Default: 1")
+    parser.add_argument("--calls", default="2000",
+                        help="Timed calls per stage (clean_controller: 1 per csv file); Default: 2000")
+    parser.add_argument("--warmup", default="50",
+                        help="Untimed calls before measuring; Default: 50")
+    parser.add_argument("--alloc_calls", default="50",
+                        help="Calls traced with tracemalloc; Default: 50")
+    parser.add_argument("--chunk_size", default="0",
+                        help="FilterCSV chunk_size for clean_controller; Default: 0 (whole file)")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="JSON file for results; Default: bench_results.json")
+    parser.add_argument("--compare", nargs=2, default=argparse.SUPPRESS, metavar=("OLD", "NEW"),
+                        help="Compare 2 result files instead of measuring")
+    parser.add_argument("--threshold", default="0.1",
+                        help="With --compare, exit with 1 when a stage's p50 is this fraction slower; Default: 0.1")
+
+    args, leftovers = parser.parse_known_args()
+    print("The following arguments are used: {}".format(args))
+    print("The following arguments are ignored: {}\n".format(leftovers))
+
+    if 'compare' in args:
+        regressions = compare(*args.compare, float(args.threshold))
+        sys.exit(1 if regressions else 0)
+
+    stage_names = [name for name in STAGES
+                   if not args.stages or any(s in name for s in args.stages.split(","))]
+    stages = run_stages(stage_names, int(args.scale), int(args.calls), int(args.warmup), int(args.alloc_calls),
+                        int(args.chunk_size))
+
+    results = {'meta': {'commit': git_commit(), 'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+                        'python': platform.python_version(), 'platform': platform.platform(),
+                        'numpy': np.__version__, 'pandas': pd.__version__,
+                        'scale': int(args.scale)},
+               'stages': stages}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("\nResults written to {}".format(args.output))
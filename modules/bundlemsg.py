@@ -0,0 +1,35 @@
+"""Bundled messages: all participants of 1 frame tick in a single message
+
+Topic: <key>.bundle.<group name>[.s<k>]
+Data: {'frame': .., 'timestamp': .., 'bundle': {'p0[.s<k>].<csv name>': data p0, 'p1[.s<k>].<csv name>': data p1, ..}}
+
+Data per participant is the same as a normal message of that participant (or '' when not enough confidence).
+Unbundling publishes every section on <key>.p<i>[.s<k>].<csv name>, the topic used when not bundling.
+"""
+
+# Copyright (c) Stef van der Struijk.
+# License: GNU Lesser General Public License
+
+
+BUNDLE_KEY = "bundle"
+
+
+# True when message data (dict) is a bundle
+def is_bundle(data):
+    return isinstance(data, dict) and BUNDLE_KEY in data
+
+
+# bundle topic of a group of participants
+def bundle_topic(prefix, group_name):
+    return "{}.{}.{}".format(prefix, BUNDLE_KEY, group_name) if prefix else "{}.{}".format(BUNDLE_KEY, group_name)
+
+
+# section topic: bundle topic with '.bundle.<group name>' replaced by '.<section key>'
+def section_topic(topic, section_key):
+    base = topic.split("." + BUNDLE_KEY + ".")[0] if ("." + BUNDLE_KEY + ".") in topic else ""
+    return base + "." + section_key if base else section_key
+
+
+# list of (topic, data) per participant
+def unbundle(topic, data):
+    return [(section_topic(topic, key), section) for key, section in data[BUNDLE_KEY].items()]
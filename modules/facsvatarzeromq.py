@@ -15,7 +15,7 @@ from zmq.asyncio import Context
 class FACSvatarZeroMQ(abstractmethod(ABC)):
     """Base class for initializing FACSvatar ZeroMQ sockets"""
 
-    def __init__(self, pub_ip='127.0.0.1', pub_port=None, pub_key='', pub_bind=True,
+    def __init__(self, pub_ip='127.0.0.1', pub_port=None, pub_key='', pub_bind=True, pub_xpub=False,
                  sub_ip='127.0.0.1', sub_port=None, sub_key='', sub_bind=False,
                  deal_ip='127.0.0.1', deal_port=None, deal_key='', deal_topic='', deal_bind=False,
                  deal2_ip='127.0.0.1', deal2_port=None, deal2_key='', deal2_topic='', deal2_bind=False,
@@ -28,6 +28,7 @@ class FACSvatarZeroMQ(abstractmethod(ABC)):
         xxx_port: port of publisher/subscriber/dealer/router
         xxx_key: key for filtering out messages (leave empty to receive all) (pub/sub only)
         xxx_bind: True for bind (only 1 socket can bind to 1 address) or false for connect (many can connect)
+        pub_xpub: True for XPUB instead of PUB; subscriptions can be received with pub_socket.recv()
         """
 
         # get ZeroMQ version
@@ -40,7 +41,7 @@ class FACSvatarZeroMQ(abstractmethod(ABC)):
         # set-up publish socket only if a port is given
         if pub_port:
             print("Publisher port is specified")
-            self.pub_socket = self.zeromq_context(pub_ip, pub_port, zmq.PUB, pub_bind)
+            self.pub_socket = self.zeromq_context(pub_ip, pub_port, zmq.XPUB if pub_xpub else zmq.PUB, pub_bind)
             # add variable with key
             self.pub_key = pub_key
             print("Publisher socket set-up complete")
@@ -132,8 +133,10 @@ class FACSvatarZeroMQ(abstractmethod(ABC)):
             # capture ZeroMQ errors; ZeroMQ using asyncio doesn't print out errors
             # TODO working properly?
             try:
-                asyncio.get_event_loop().run_until_complete(asyncio.wait(
-                    [func() for func in async_func_list]
+                # wrap in futures; newer Python versions don't accept coroutines in asyncio.wait()
+                loop = asyncio.get_event_loop()
+                loop.run_until_complete(asyncio.wait(
+                    [asyncio.ensure_future(func(), loop=loop) for func in async_func_list]
                 ))
             except Exception as e:
                 print("Error with async function")
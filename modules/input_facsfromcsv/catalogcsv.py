@@ -0,0 +1,152 @@
+"""Persistent catalog of cleaned OpenFace .csv files
+
+- Stores metadata per file in SQLite: rows, duration, frame rate, confidence statistics
+- Only (re)reads files that are new or changed since the last update
+- Groups files by participant suffix: name_p0.csv, name_p1.csv --> group 'name'
+
+Saves catalog as catalog.sqlite in the folder with cleaned files
+"""
+
+# Copyright (c) Stef van der Struijk.
+# License: GNU Lesser General Public License
+
+
+import os
+import re
+import sqlite3
+from pathlib import Path
+import pandas as pd
+
+
+# catalog of csv files in a folder
+class CatalogCSV:
+    # name_p0 / name_P1 --> ('name', '0') / ('name', '1')
+    participant_reg = re.compile(r"^(.*)_[pP](\d+)$")
+
+    def __init__(self, csv_folder, db_name="catalog.sqlite"):
+        """Opens (or creates) the catalog of a folder
+
+        :param csv_folder: Path object to folder with cleaned csv files
+        :param db_name: file name of SQLite database inside csv_folder
+        """
+
+        self.csv_folder = Path(csv_folder)
+        os.makedirs(self.csv_folder, exist_ok=True)
+
+        self.db = sqlite3.connect(str(self.csv_folder / db_name))
+        self.db.execute("CREATE TABLE IF NOT EXISTS csv_file ("
+                        "name TEXT PRIMARY KEY, "  # file name without .csv
+                        "mtime REAL, size INTEGER, "  # detect changed files
+                        "rows INTEGER, duration REAL, fps REAL, "
+                        "confidence_mean REAL, confidence_min REAL, "
+                        "group_name TEXT, participant INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_group ON csv_file (group_name, participant)")
+        self.db.commit()
+
+    # add new / changed files, remove deleted files
+    def update(self):
+        # stored name: (mtime, size)
+        known = {name: (mtime, size) for name, mtime, size in self.db.execute("SELECT name, mtime, size FROM csv_file")}
+
+        found = set()
+        for entry in os.scandir(self.csv_folder):
+            if not entry.is_file() or not entry.name.endswith(".csv"):
+                continue
+
+            name = entry.name[:-4]
+            found.add(name)
+            stat = entry.stat()
+
+            # unchanged since last update
+            if known.get(name) == (stat.st_mtime, stat.st_size):
+                continue
+
+            print("Cataloging: {}".format(entry.name))
+            self.db.execute("INSERT OR REPLACE INTO csv_file VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (name, stat.st_mtime, stat.st_size, *self.file_metadata(entry.path),
+                             *self.participant_split(name)))
+
+        # files no longer in folder
+        removed = [(name,) for name in known if name not in found]
+        self.db.executemany("DELETE FROM csv_file WHERE name = ?", removed)
+        self.db.commit()
+
+    # rows, duration, fps, confidence mean and min of a cleaned csv
+    def file_metadata(self, csv_path):
+        header = pd.read_csv(csv_path, nrows=0).columns
+        df = pd.read_csv(csv_path, usecols=[c for c in ('timestamp', 'confidence') if c in header])
+
+        rows = df.shape[0]
+        duration = float(df['timestamp'].iloc[-1] - df['timestamp'].iloc[0]) if rows else 0.0
+        fps = (rows - 1) / duration if duration > 0 else 0.0
+        # no confidence column; same as OpenFaceMessage
+        if 'confidence' in df and rows:
+            confidence = (float(df['confidence'].mean()), float(df['confidence'].min()))
+        else:
+            confidence = (1.0, 1.0)
+
+        return (rows, duration, fps, *confidence)
+
+    # group name and participant number; files without _p* are their own group
+    def participant_split(self, name):
+        match = self.participant_reg.match(name)
+        if match:
+            return match.group(1), int(match.group(2))
+        return name, None
+
+    # all files, sorted by name
+    def files(self):
+        return [self.csv_folder / (name + ".csv")
+                for name, in self.db.execute("SELECT name FROM csv_file ORDER BY name")]
+
+    def query(self, min_duration=None, max_duration=None, participants=None, pattern=None):
+        """Returns csv groups matching the query; files of a group are sorted by participant
+
+        :param min_duration: shortest file in group at least x seconds
+        :param max_duration: longest file in group at most x seconds
+        :param participants: number of files in group
+        :param pattern: file name pattern with wildcards, e.g. '2people*'
+        :return: list of csv groups, e.g. [[name_p0.csv, name_p1.csv], [other.csv]]
+        """
+
+        where = []
+        having = []
+        param_where = []
+        param_having = []
+
+        if pattern:
+            where.append("name GLOB ?")
+            param_where.append(pattern[:-4] if pattern.endswith(".csv") else pattern)
+        if min_duration is not None:
+            having.append("MIN(duration) >= ?")
+            param_having.append(min_duration)
+        if max_duration is not None:
+            having.append("MAX(duration) <= ?")
+            param_having.append(max_duration)
+        if participants is not None:
+            having.append("COUNT(*) = ?")
+            param_having.append(participants)
+
+        sql = "SELECT group_name FROM csv_file"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY group_name"
+        if having:
+            sql += " HAVING " + " AND ".join(having)
+        sql += " ORDER BY group_name"
+        group_names = [g for g, in self.db.execute(sql, param_where + param_having)]
+
+        # files per matching group
+        csv_groups = []
+        for group_name in group_names:
+            sql = "SELECT name FROM csv_file WHERE group_name = ?"
+            if where:
+                sql += " AND " + " AND ".join(where)
+            sql += " ORDER BY participant, name"
+            csv_groups.append([self.csv_folder / (name + ".csv")
+                               for name, in self.db.execute(sql, [group_name] + param_where)])
+
+        return csv_groups
+
+    def close(self):
+        self.db.close()
@@ -12,17 +12,19 @@ Saves cleaned csv in path/to/folder_clean
 
 
 import os
+import re
 from pathlib import Path
 import pandas as pd
 
 
 # clean csv output of OpenFace, remove irrelevant columns
 class FilterCSV:
-    def __init__(self, col_keep=None):  # , dir_processed, col_keep, dir_timestamp
+    def __init__(self, col_keep=None, chunk_size=0):  # , dir_processed, col_keep, dir_timestamp
         """Transform csv to Panda dataframe which can be accessed by other functions
 
         :param csv_file: Path object to csv file
         :param col_keep:
+        :param chunk_size: rows per chunk when cleaning in streaming mode; 0 loads the whole csv at once
 
         If cleaned csv exist, skip cleaning and load directly as dataframe
         """
@@ -35,6 +37,8 @@ class FilterCSV:
         self.df_csv = None
         # Action Units and head rotation
         self.col_keep = col_keep  # , 'gaze_angle*'
+        # streaming mode when > 0; peak memory bounded by chunk size instead of file length
+        self.chunk_size = chunk_size
 
         #   skip cleaning and load clean as dataframe
         # change string to path object
@@ -67,8 +71,8 @@ class FilterCSV:
         self.df_csv.drop(self.df_csv[(self.df_csv.success == 0) | (self.df_csv.confidence < 0.8)].index,
                         inplace=True)
 
-    # remove unnecessary columns
-    def clean_columns(self):
+    # regex matching the column names we keep
+    def col_regex(self):
         if len(self.col_keep) >= 1:
             # doesn't include AU28_c (lip suck), which has no AU28_r
             reg = "(frame)|(timestamp)|(confidence)|(success)|{}" \
@@ -76,7 +80,36 @@ class FilterCSV:
         else:
             reg = "(frame)|(timestamp)|(confidence)"
         # print("regex col filter: {}".format(reg))
-        self.df_csv = self.df_csv.filter(regex=reg)
+        return reg
+
+    # indices and stripped names of header columns we keep; used for cleaning row by row
+    def header_keep(self, header):
+        reg = re.compile(self.col_regex())
+        return [(i, c.strip()) for i, c in enumerate(header) if reg.search(c.strip())]
+
+    # clean a single row of values; same result as a row of clean_controller()
+    def clean_row(self, col_keep, values, frame):
+        """ Cleans 1 raw OpenFace row, e.g. while OpenFace is still writing the csv
+
+        :param col_keep: output of header_keep()
+        :param values: list of strings of a single csv row
+        :param frame: row number since start of file (match_index_frame)
+        :return: dict of column name: value
+        """
+
+        row = {c: float(values[i]) for i, c in col_keep}
+        row['frame'] = frame
+
+        # AU*_r from 0-5 to 0-1
+        for c in row:
+            if c.startswith("AU") and c.endswith("_r"):
+                row[c] /= 5
+
+        return row
+
+    # remove unnecessary columns
+    def clean_columns(self):
+        self.df_csv = self.df_csv.filter(regex=self.col_regex())
 
     def match_index_frame(self):
         self.df_csv['frame'] = self.df_csv.index
@@ -110,7 +143,7 @@ class FilterCSV:
         # self.df_csv.to_csv(csv_file[:-4] + "_clean.csv", index=False)  # , columns=[]
         self.df_csv.to_csv(csv_clean, index=False)
 
-        # calls all cleaning + save functions
+    # calls all cleaning + save functions
     def clean_controller(self, csv_raw, csv_folder_clean):
         """ Manages cleaning of raw openface csv file
 
@@ -119,6 +152,10 @@ class FilterCSV:
         :return:
         """
 
+        # large files: don't load whole csv in memory
+        if self.chunk_size > 0:
+            return self.clean_controller_stream(csv_raw, csv_folder_clean)
+
         print("Cleaning: {} and save to {}".format(csv_raw, csv_folder_clean))
         self.df_csv = pd.read_csv(csv_raw)
 
@@ -142,3 +179,50 @@ class FilterCSV:
 
         # save cleaned dataframe; add csv file name to clean path
         self.csv_save(csv_folder_clean / csv_raw.name)
+
+    # cleans csv chunk by chunk; only the kept columns are parsed
+    def clean_controller_stream(self, csv_raw, csv_folder_clean):
+        """ Manages cleaning of raw openface csv file in fixed-size chunks
+
+        Same result as clean_controller, but columns are selected while parsing, values are downcast to float32
+        and every chunk is appended to the cleaned csv before the next one is read.
+
+        :param csv_raw: path to raw file
+        :param csv_folder_clean: path to folder with cleaned files
+        :return:
+        """
+
+        print("Cleaning (chunks of {} rows): {} and save to {}".format(self.chunk_size, csv_raw, csv_folder_clean))
+
+        # only read header to find columns to keep; OpenFace headers contain spaces, e.g. ' confidence'
+        header = pd.read_csv(csv_raw, nrows=0).columns
+        reg = re.compile(self.col_regex())
+        usecols = [c for c in header if reg.search(c.strip())]
+
+        # float32 for tracking data; frame is replaced by index and timestamp needs full precision
+        dtype = {c: 'float32' for c in usecols if c.strip() not in ('frame', 'timestamp', 'success')}
+
+        # write to temporary file first, so an interrupted clean is not mistaken for a finished one
+        csv_clean = csv_folder_clean / csv_raw.name
+        csv_part = csv_clean.with_name(csv_clean.name + ".part")
+        os.makedirs(csv_clean.parents[0], exist_ok=True)
+
+        # chunks keep a continuing index, so match_index_frame() gives the same frame numbers
+        reader = pd.read_csv(csv_raw, usecols=usecols, dtype=dtype, chunksize=self.chunk_size)
+        for i, df_chunk in enumerate(reader):
+            self.df_csv = df_chunk
+            self.clean_header_space()
+            # keep column order of clean_controller()
+            self.clean_columns()
+            self.match_index_frame()
+            self.reset_au_interval()
+
+            # header only once
+            self.df_csv.to_csv(csv_part, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+
+        # empty csv; still write header
+        if not csv_part.exists():
+            pd.DataFrame(columns=[c.strip() for c in usecols]).to_csv(csv_part, index=False)
+
+        os.replace(csv_part, csv_clean)
+        self.df_csv = None
@@ -15,7 +15,9 @@ import argparse
 import time
 # import glob
 import json
+import heapq
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
 
@@ -26,9 +28,15 @@ if __name__ == '__main__':
     sys.path.append("..")
     from facsvatarzeromq import FACSvatarZeroMQ
     from openfacefiltercsv import FilterCSV
+    from catalogcsv import CatalogCSV
+    from resamplecsv import ResampleCSV
+    from bundlemsg import bundle_topic, BUNDLE_KEY
 else:
     from modules.facsvatarzeromq import FACSvatarZeroMQ
+    from modules.bundlemsg import bundle_topic, BUNDLE_KEY
     from .openfacefiltercsv import FilterCSV
+    from .catalogcsv import CatalogCSV
+    from .resamplecsv import ResampleCSV
 
 
 # goes through 'openface' folder to find latest .csv
@@ -38,11 +46,19 @@ class CrawlerCSV:
     Filenames with _P* are messaged together
     """
 
-    def __init__(self):
-        self.filter_csv = FilterCSV()
+    def __init__(self, chunk_size=0):
+        # chunk_size > 0: clean large raw csv files in streaming mode
+        self.filter_csv = FilterCSV(chunk_size=chunk_size)
 
     # returns list of .csv files used for generating messages
-    def gather_csv_list(self, csv_folder_raw, csv_arg):
+    def gather_csv_list(self, csv_folder_raw, csv_arg, catalog_query=None):
+        """
+        :param csv_folder_raw: folder with raw OpenFace csv files; cleaned files are in folder_clean
+        :param csv_arg: csv_file_name, -2, -1, >=0
+        :param catalog_query: dict of CatalogCSV.query() arguments to select csv groups when csv_arg == -2
+        :return: list of csv groups
+        """
+
         csv_folder_raw = Path(csv_folder_raw)
 
         # get all csv files in folder raw
@@ -69,6 +85,10 @@ class CrawlerCSV:
                 self.filter_csv.clean_controller(csv_folder_raw / raw, csv_folder_clean)
                 # self.filter_csv()
 
+        # metadata of cleaned files; only new / changed files are read
+        catalog = CatalogCSV(csv_folder_clean)
+        catalog.update()
+
         #   use argument to determine which csv files will be returned for message generation
         csv_message_list = []
         # find specific file if file name and not a number is given as argument
@@ -81,7 +101,7 @@ class CrawlerCSV:
             csv_arg = int(csv_arg)
             print(f"Number is given as argument: {csv_arg}")
             # get all cleaned csv, including new ones
-            csv_all_clean = sorted(self.search_csv(csv_folder_clean, "*", True))
+            csv_all_clean = catalog.files()
 
             # files were found
             if csv_all_clean:
@@ -92,10 +112,9 @@ class CrawlerCSV:
 
                 # return all files
                 if csv_arg == -2:
-                    # every csv in separate list to create csv groups existing out of 1 csv file
+                    # files with _P* in same csv group, other files in a group of their own
                     print("\nre-listing")
-                    print(csv_all_clean)
-                    csv_message_list = [[x] for x in csv_all_clean]
+                    csv_message_list = catalog.query(**(catalog_query or {}))
                     print()
                     print(csv_message_list)
                     print("\n")
@@ -126,6 +145,8 @@ class CrawlerCSV:
             else:
                 print(f"No csv files found in folder {csv_folder_clean}")
 
+        catalog.close()
+
         # return final list of csv files
         print(f"List of csv files for messaging: {csv_message_list}")
         return csv_message_list
@@ -237,6 +258,30 @@ class OpenFaceMessage:
             self.msg['pose'] = self.df_head_pose.loc[frame_tracker].to_dict()
             # print(msg['pose'])
 
+    # set message from a single cleaned row (dict); used when no dataframe exists, e.g. live data
+    def set_msg_row(self, row):
+        # init a message dict
+        self.msg = dict()
+
+        # get confidence in tracking if exist, else set it to 1.0
+        self.msg['confidence'] = row.get('confidence', 1.0)
+
+        # metadata in message
+        self.msg['frame'] = int(row['frame'])
+        self.msg['timestamp'] = row['timestamp']
+
+        # check confidence high enough, else return None as data
+        if self.msg['confidence'] >= .7:
+            # au_regression in message; AU**_r --> AU**
+            self.msg['au_r'] = {k.replace('_r', ''): v for k, v in row.items() if k.startswith("AU")}
+
+            # eye gaze in message
+            if 'gaze_angle_x' in row:
+                self.msg['gaze'] = {'gaze_angle_x': row['gaze_angle_x'], 'gaze_angle_y': row['gaze_angle_y']}
+
+            # head pose in message
+            self.msg['pose'] = {k: v for k, v in row.items() if k.startswith("pose_")}
+
     def set_reset_msg(self):
         # init a message dict
         self.msg = dict()
@@ -269,36 +314,82 @@ class OpenFaceMsgFromCSV:
 
     """
 
-    def __init__(self, csv_arg, csv_folder='openface', every_x_frames=1):  # client
+    def __init__(self, csv_arg, csv_folder='openface', every_x_frames=1, chunk_size=0,
+                 concurrent=0, concurrent_offset=0.0, prefetch=1, catalog_query=None,
+                 fps=0, fps_method='linear', bundle=False):  # client
         """
         generates messages from OpenFace .csv files
 
         :param csv_arg: csv_file_name, -2, -1, >=0
         :param csv_folder: where to look for csv files
         :param every_x_frames: send message when frame % every_x_frames == 0
+        :param chunk_size: rows per chunk when cleaning raw csv files; 0 cleans whole file at once
+        :param concurrent: number of csv groups played at the same time; 0 plays groups one after another
+        :param concurrent_offset: seconds between start of repeated csv groups (concurrent > number of groups)
+        :param prefetch: number of next csv groups loaded in background while playing; limits memory use
+        :param catalog_query: dict with min_duration, max_duration, participants and/or pattern for csv_arg -2
+        :param fps: resample csv files to this frame rate before sending; 0 keeps recorded frame rate
+        :param fps_method: 'linear' or 'spline' interpolation when resampling
+        :param bundle: send all participants of a csv group in 1 message per frame (see bundlemsg)
         """
 
-        self.crawler = CrawlerCSV()
-        self.csv_list = self.crawler.gather_csv_list(csv_folder, csv_arg)
+        self.crawler = CrawlerCSV(chunk_size)
+        self.csv_list = self.crawler.gather_csv_list(csv_folder, csv_arg, catalog_query)
         print(f"using csv files: {self.csv_list}")
         self.reset_msg = OpenFaceMessage()
         self.reset_msg.set_reset_msg()
         self.every_x_frames = every_x_frames
+        self.concurrent = concurrent
+        self.concurrent_offset = concurrent_offset
+        self.prefetch = prefetch
+        self.bundle = bundle
+        self.fps = fps
+        if fps > 0:
+            self.resample_csv = ResampleCSV(fps_method)
 
     # loop over all csv groups ([1 csv file] if single person, P1, P2, etc [multi csv files]
     async def msg_gen(self):
-        for csv_group in self.csv_list:
+        # play groups in parallel instead
+        if self.concurrent > 0:
+            async for msg in self.msg_gen_concurrent():
+                yield msg
+            return
+
+        # load csv groups in a worker thread, so the event loop isn't blocked between groups
+        loop = asyncio.get_event_loop()
+        executor = ThreadPoolExecutor(max_workers=1)
+        # csv group index: future of load_csv_group()
+        group_futures = {}
+
+        for n, csv_group in enumerate(self.csv_list):
+            # start loading current group (if not prefetched) and up to self.prefetch groups ahead
+            for m in range(n, min(n + 1 + self.prefetch, len(self.csv_list))):
+                if m not in group_futures:
+                    group_futures[m] = loop.run_in_executor(executor, self.load_csv_group, self.csv_list[m])
+            group_data = await group_futures.pop(n)
+
             print("\n\n")
             time_start = time.time()
             print(csv_group)
             # sys.exit("\nCSV crawler check finished")
 
-            async for i, msg in self.msg_from_csv(csv_group):
+            # messages of current frame when bundling
+            msg_tick = []
+
+            async for i, msg in self.msg_from_csv(csv_group, group_data):
                 print(msg)
                 timestamp = time.time()
 
+                # return group name, timestamp and all msgs of this frame as 1 JSON string
+                if self.bundle:
+                    msg_tick.append(msg)
+                    if i == len(csv_group) - 1:
+                        yield self.bundle_msg(csv_group, msg_tick, timestamp - time_start)
+                        msg_tick = []
+
                 # return filename, timestamp and msg as JSON string
-                yield f"p{i}." + csv_group[i].stem, timestamp - time_start, json.dumps(msg)
+                else:
+                    yield f"p{i}." + csv_group[i].stem, timestamp - time_start, json.dumps(msg)
 
             # continue frame count
             # frame = msg['frame']
@@ -312,16 +403,123 @@ class OpenFaceMsgFromCSV:
                 yield "reset", timestamp - time_start, json.dumps(self.reset_msg.msg)
             await asyncio.sleep(.2)
 
+        executor.shutdown(wait=False)
+
         # return that messages are finished (Python >= 3.6)
         yield None
 
-    # generator for FACS and head pose messages
-    async def msg_from_csv(self, csv_group):
+    # play csv groups at the same time, each as separate stream on a single clock
+    async def msg_gen_concurrent(self):
         """
-        Generates messages from a csv file
+        Generates messages of self.concurrent streams in parallel
+
+        Stream k plays csv group k % len(csv_list); groups are repeated with concurrent_offset seconds in between
+        when more streams than groups are requested. Topics get s{k} after the participant (p{i}.s{k}.<csv name>) to
+        keep streams apart, so per participant subscriptions (e.g. openface.p0.) still match.
+        A single heap of (due time, stream, frame) schedules all streams; no coroutine per stream.
+        """
+
+        if not self.csv_list:
+            yield None
+            return
+
+        # load every group only once, even when replayed by several streams
+        group_data = [self.load_csv_group(csv_group) for csv_group in self.csv_list]
+        # recorded timestamps of first user per group
+        group_time = [ofmsg_list[0].df_csv['timestamp'].values for ofmsg_list, _ in group_data]
+
+        # heap with next frame per stream
+        schedule = []
+        for k in range(self.concurrent):
+            g = k % len(self.csv_list)
+            offset = (k // len(self.csv_list)) * self.concurrent_offset
+            if group_data[g][1] > 0:
+                schedule.append((group_time[g][0] + offset, k, 0))
+        heapq.heapify(schedule)
+        print("Playing {} streams concurrently".format(len(schedule)))
+
+        timer = time.time()
+        report_time = timer
+        report_count = 0
+        msg_count = 0
+
+        while schedule:
+            time_due, k, frame_tracker = heapq.heappop(schedule)
+            g = k % len(self.csv_list)
+            ofmsg_list, row_count = group_data[g]
+
+            # wait until timer time matches timestamp
+            time_sleep = time_due - (time.time() - timer)
+            if time_sleep > 0:
+                await asyncio.sleep(time_sleep)
+
+            # reduce frame rate
+            if frame_tracker % self.every_x_frames == 0:
+                msg_tick = []
+                for i, ofmsg in enumerate(ofmsg_list):
+                    # csv files in group can have a different length
+                    if frame_tracker >= ofmsg.df_csv.shape[0]:
+                        msg_tick.append('')
+                        continue
+
+                    ofmsg.set_msg(frame_tracker)
+                    msg_tick.append(ofmsg.msg if 'au_r' in ofmsg.msg else '')
+
+                    # return participant + stream + filename, timestamp and msg as JSON string
+                    if not self.bundle:
+                        yield f"p{i}.s{k}." + self.csv_list[g][i].stem, time.time() - timer, json.dumps(msg_tick[i])
+                        msg_count += 1
+
+                # return stream + group name, timestamp and all msgs of this frame as 1 JSON string
+                if self.bundle:
+                    yield self.bundle_msg(self.csv_list[g], msg_tick, time.time() - timer, f"s{k}")
+                    msg_count += 1
+
+            # schedule next frame of this stream
+            if frame_tracker + 1 < row_count and frame_tracker + 1 < len(group_time[g]):
+                offset = (k // len(self.csv_list)) * self.concurrent_offset
+                heapq.heappush(schedule, (group_time[g][frame_tracker + 1] + offset, k, frame_tracker + 1))
+
+            # aggregate frames per second every second
+            if time.time() - report_time >= 1:
+                print("Concurrent streams: {}, messages per second: {:.1f}"
+                      .format(len(schedule), (msg_count - report_count) / (time.time() - report_time)))
+                report_time = time.time()
+                report_count = msg_count
+
+        print("Concurrent replay done: {} messages in {:.2f} s ({:.1f} messages per second)"
+              .format(msg_count, time.time() - timer, msg_count / max(time.time() - timer, 1e-9)))
+
+        # send few empty messages when all streams are done
+        await asyncio.sleep(1)
+        for i in range(5):
+            await asyncio.sleep(.05)
+            yield "reset", time.time() - timer, json.dumps(self.reset_msg.msg)
+
+        # return that messages are finished (Python >= 3.6)
+        yield None
+
+    # all msgs of 1 frame of a csv group as a single bundled message; stream: s{k} of concurrent replay
+    def bundle_msg(self, csv_group, msg_tick, time_passed, stream=None):
+        # group name without participant suffix
+        group_name = CatalogCSV.participant_reg.sub(r"\1", csv_group[0].stem)
+        stream_key = stream + "." if stream else ""
+
+        # frame info from first participant with data
+        msg = next((m for m in msg_tick if m), {})
+        bundle = {'frame': msg.get('frame', -1), 'timestamp': msg.get('timestamp', 0.0),
+                  BUNDLE_KEY: {f"p{i}." + stream_key + csv.stem: m
+                               for i, (csv, m) in enumerate(zip(csv_group, msg_tick))}}
+
+        return bundle_topic("", group_name + ("." + stream if stream else "")), time_passed, json.dumps(bundle)
+
+    # load csv files of a group as message objects
+    def load_csv_group(self, csv_group):
+        """
+        Loads csv files and prepares a message object per csv file
 
         :param csv_group: list of path + file name(s) of csv file(s)
-        :return: data of a message to be send in JSON
+        :return: list of OpenFaceMessage, highest row count
         """
 
         # if no csv in csv_group; range(0) == skip
@@ -331,6 +529,10 @@ class OpenFaceMsgFromCSV:
 
         # load OpenFace csv as dataframe
         for csv in csv_group:
+            # use (cached) csv with target frame rate
+            if self.fps > 0:
+                csv = self.resample_csv.resample_file(csv, self.fps)
+
             # read csv as Pandas dataframe
             df_csv = pd.read_csv(csv)  # FilterCSV(csv).df_csv
             print(df_csv.head())
@@ -356,6 +558,22 @@ class OpenFaceMsgFromCSV:
             ofmsg.df_split()
             ofmsg_list.append(ofmsg)
 
+        return ofmsg_list, df_au_row_count
+
+    # generator for FACS and head pose messages
+    async def msg_from_csv(self, csv_group, group_data=None):
+        """
+        Generates messages from a csv file
+
+        :param csv_group: list of path + file name(s) of csv file(s)
+        :param group_data: result of load_csv_group(csv_group) when already loaded, e.g. prefetched
+        :return: data of a message to be send in JSON
+        """
+
+        if group_data is None:
+            group_data = self.load_csv_group(csv_group)
+        ofmsg_list, df_au_row_count = group_data
+
         # get current time to match timestamp when publishing
         timer = time.time()
 
@@ -392,14 +610,140 @@ class OpenFaceMsgFromCSV:
                         yield i, ''
 
 
+# follows a csv while OpenFace is still writing to it
+class OpenFaceMsgFromTail:
+    """
+    Publishes FACS (Action Units) and head pos data from a growing OpenFace .csv
+
+    Every appended row is cleaned like FilterCSV does and send as soon as it's written
+    """
+
+    def __init__(self, csv_tail, every_x_frames=1, poll_interval=.005, tail_timeout=10):
+        """
+        generates messages from a csv file that is being written
+
+        :param csv_tail: path to csv file OpenFace writes to (file doesn't need to exist yet)
+        :param every_x_frames: send message when frame % every_x_frames == 0
+        :param poll_interval: seconds to wait before checking for new data
+        :param tail_timeout: seconds without new data before stopping; <= 0 keeps following forever
+        """
+
+        self.csv_tail = Path(csv_tail)
+        self.filter_csv = FilterCSV()
+        self.every_x_frames = every_x_frames
+        self.poll_interval = poll_interval
+        self.tail_timeout = tail_timeout
+
+    # yields complete lines appended to file; partial lines are kept until finished
+    async def line_gen(self):
+        # wait for OpenFace to create file
+        while not self.csv_tail.exists():
+            print("Waiting for {} to be created".format(self.csv_tail))
+            await asyncio.sleep(.5)
+
+        with open(self.csv_tail, 'rb') as f:
+            buffer = b''
+            time_data = time.time()
+
+            while True:
+                data = f.read()
+
+                if data:
+                    time_data = time.time()
+                    buffer += data
+                    # last element is an unfinished line or b''
+                    *lines, buffer = buffer.split(b'\n')
+                    for line in lines:
+                        line = line.strip()
+                        if line:
+                            yield line.decode('utf-8')
+
+                else:
+                    # file truncated / overwritten by a new recording; start from the beginning
+                    if os.path.getsize(self.csv_tail) < f.tell():
+                        print("File truncated, reading from start")
+                        f.seek(0)
+                        buffer = b''
+                        yield None
+
+                    elif 0 < self.tail_timeout < time.time() - time_data:
+                        print("No new data for {} seconds".format(self.tail_timeout))
+                        return
+
+                    await asyncio.sleep(self.poll_interval)
+
+    async def msg_gen(self):
+        print("Following: {}".format(self.csv_tail))
+        time_start = time.time()
+        col_keep = None
+        frame = 0
+        ofmsg = OpenFaceMessage()
+
+        async for line in self.line_gen():
+            # new file; discover header again
+            if line is None:
+                col_keep = None
+                continue
+
+            values = line.split(',')
+
+            # first line is header
+            if col_keep is None:
+                col_keep = self.filter_csv.header_keep(values)
+                print("Header found, using columns: {}".format([c for i, c in col_keep]))
+                frame = 0
+                continue
+
+            # reduce frame rate
+            if frame % self.every_x_frames == 0:
+                try:
+                    row = self.filter_csv.clean_row(col_keep, values, frame)
+                # written row doesn't match header
+                except (IndexError, ValueError):
+                    print("Skipping incomplete row: {}".format(line))
+                    continue
+
+                ofmsg.set_msg_row(row)
+
+                # return filename, timestamp and msg as JSON string; empty msg when not enough confidence
+                yield "p0." + self.csv_tail.stem, time.time() - time_start, \
+                      json.dumps(ofmsg.msg) if 'au_r' in ofmsg.msg else json.dumps('')
+
+            frame += 1
+
+        # return that messages are finished (Python >= 3.6)
+        yield None
+
+
 class FACSvatarMessages(FACSvatarZeroMQ):
     """Publishes FACS and Head movement data from .csv files generated by OpenFace"""
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        # follow csv OpenFace is writing to
+        if self.misc['csv_tail']:
+            self.openface_msg = OpenFaceMsgFromTail(self.misc['csv_tail'], int(self.misc['every_x_frames']),
+                                                    tail_timeout=float(self.misc['tail_timeout']))
         # init class to process .csv files
-        self.openface_msg = OpenFaceMsgFromCSV(self.misc['csv_arg'], self.misc['csv_folder'],
-                                               int(self.misc['every_x_frames']))
+        else:
+            self.openface_msg = OpenFaceMsgFromCSV(self.misc['csv_arg'], self.misc['csv_folder'],
+                                                   int(self.misc['every_x_frames']), int(self.misc['chunk_size']),
+                                                   int(self.misc['concurrent']),
+                                                   float(self.misc['concurrent_offset']),
+                                                   int(self.misc['prefetch']),
+                                                   self.catalog_query(),
+                                                   float(self.misc['fps']), self.misc['fps_method'],
+                                                   self.misc['bundle'] in (True, "True", "true", "1"))
+
+    # selection of csv groups for csv_arg -2 from command line arguments
+    def catalog_query(self):
+        catalog_query = {}
+        for key, cast in (('min_duration', float), ('max_duration', float), ('participants', int),
+                          ('pattern', str)):
+            if self.misc.get(key):
+                catalog_query[key] = cast(self.misc[key])
+
+        return catalog_query
 
     # publishes facs values per frame to subscription key 'facs'
     async def facs_pub(self):
@@ -452,6 +796,33 @@ if __name__ == '__main__':
                         help="Name of folder with csv files; Default: openface")
     parser.add_argument("--every_x_frames", default="1",
                         help="Send every x frames a msg; Default 1 (all)")
+    parser.add_argument("--chunk_size", default="0",
+                        help="Clean raw csv files in chunks of x rows to limit memory use; Default 0 (whole file)")
+    parser.add_argument("--concurrent", default="0",
+                        help="Play x csv groups at the same time as separate streams (s0, s1, ..) "
+                             "instead of one after another; Default 0 (sequential)")
+    parser.add_argument("--concurrent_offset", default="0",
+                        help="Seconds between start of streams replaying the same csv group; Default 0")
+    parser.add_argument("--min_duration", default=None,
+                        help="-2: only csv groups of which each file is at least x seconds; Default: None")
+    parser.add_argument("--max_duration", default=None,
+                        help="-2: only csv groups of which each file is at most x seconds; Default: None")
+    parser.add_argument("--participants", default=None,
+                        help="-2: only csv groups with x participants (name_p0.csv, name_p1.csv, ..); Default: None")
+    parser.add_argument("--pattern", default=None,
+                        help="-2: only csv files matching name pattern (allows for wildcard *); Default: None")
+    parser.add_argument("--fps", default="0",
+                        help="Resample csv files to x frames per second; Default 0 (recorded frame rate)")
+    parser.add_argument("--fps_method", default="linear",
+                        help="Interpolation used for --fps: linear or spline; Default: linear")
+    parser.add_argument("--bundle", default=False,
+                        help="True: 1 message per frame with all participants of a csv group; Default: False")
+    parser.add_argument("--prefetch", default="1",
+                        help="Number of next csv groups loaded in background while playing; Default 1")
+    parser.add_argument("--csv_tail", default="",
+                        help="Follow a csv file while OpenFace writes to it (live); Default: '' (replay csv files)")
+    parser.add_argument("--tail_timeout", default="10",
+                        help="Stop following csv after x seconds without new rows, <= 0 never stops; Default: 10")
 
     args, leftovers = parser.parse_known_args()
     print("The following arguments are used: {}".format(args))
@@ -0,0 +1,114 @@
+"""Resamples a cleaned OpenFace .csv file to a target frame rate
+
+- Linear or cubic spline interpolation of AU, head pose, eye gaze and confidence
+- Head pose angles are unwrapped before and wrapped to [-pi, pi] after interpolating
+- Results are cached per (file, frame rate, method)
+
+Saves resampled csv in path/to/folder_<fps>fps_<method>
+"""
+
+# Copyright (c) Stef van der Struijk.
+# License: GNU Lesser General Public License
+
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# change frame rate of cleaned OpenFace csv data
+class ResampleCSV:
+    def __init__(self, method='linear'):
+        """
+        :param method: 'linear' or 'spline' (cubic spline, needs SciPy)
+        """
+
+        if method not in ('linear', 'spline'):
+            raise ValueError("Unknown resample method: {}".format(method))
+        self.method = method
+
+    # returns path to resampled csv; only resamples when no up-to-date cached version exists
+    def resample_file(self, csv_path, fps):
+        """
+        :param csv_path: Path object to cleaned csv file
+        :param fps: target frames per second
+        :return: Path object to resampled csv file
+        """
+
+        csv_cache = csv_path.parent.parent / "{}_{:g}fps_{}".format(csv_path.parent.name, fps, self.method) \
+            / csv_path.name
+
+        if csv_cache.exists() and csv_cache.stat().st_mtime >= csv_path.stat().st_mtime:
+            print("Using cached resampled csv: {}".format(csv_cache))
+
+        else:
+            print("Resampling {} to {} fps ({})".format(csv_path, fps, self.method))
+            df_csv = self.resample(pd.read_csv(csv_path), fps)
+            os.makedirs(csv_cache.parents[0], exist_ok=True)
+            # write to temporary file first, so an interrupted write is not used as cache
+            csv_part = csv_cache.with_name(csv_cache.name + ".part")
+            df_csv.to_csv(csv_part, index=False)
+            os.replace(csv_part, csv_cache)
+
+        return csv_cache
+
+    def resample(self, df_csv, fps):
+        """Resample dataframe with a 'timestamp' column to fps
+
+        :param df_csv: dataframe of cleaned csv
+        :param fps: target frames per second
+        :return: new dataframe with frames every 1/fps seconds
+        """
+
+        # interpolation needs strictly increasing timestamps
+        df_csv = df_csv.drop_duplicates(subset='timestamp').sort_values('timestamp')
+        # nothing to interpolate (e.g. header-only clean csv)
+        if len(df_csv) < 2:
+            return df_csv
+        time_old = df_csv['timestamp'].values
+        # new timestamps; round to prevent floating point noise in csv
+        time_new = np.round(np.arange(time_old[0], time_old[-1] + 1e-9, 1 / fps), 6)
+
+        df_new = pd.DataFrame({'frame': np.arange(time_new.shape[0]), 'timestamp': time_new})
+
+        # nearest previous value for categorical columns
+        if 'success' in df_csv:
+            idx = np.searchsorted(time_old, time_new, side='right') - 1
+            df_new['success'] = df_csv['success'].values[idx]
+
+        # all other columns interpolated at once
+        cols = [c for c in df_csv.columns if c not in ('frame', 'timestamp', 'success')]
+        values = df_csv[cols].values.astype(float)
+
+        # head rotation angles in radians; prevent interpolating the long way around at -pi / pi
+        angle_col = np.array([c.startswith("pose_R") for c in cols])
+        if angle_col.any():
+            values[:, angle_col] = np.unwrap(values[:, angle_col], axis=0)
+
+        values_new = self.interpolate(time_old, values, time_new)
+
+        if angle_col.any():
+            values_new[:, angle_col] = (values_new[:, angle_col] + np.pi) % (2 * np.pi) - np.pi
+
+        # spline can overshoot; keep AU and confidence in 0-1
+        bound_col = np.array([c.startswith("AU") or c == 'confidence' for c in cols])
+        if bound_col.any():
+            values_new[:, bound_col] = np.clip(values_new[:, bound_col], 0, 1)
+
+        # prevent floating point noise in csv
+        values_new = np.round(values_new, 6)
+
+        for i, c in enumerate(cols):
+            df_new[c] = values_new[:, i]
+
+        # original column order
+        return df_new[[c for c in df_csv.columns if c in df_new]]
+
+    # interpolate every column of values (rows: time_old) at time_new
+    def interpolate(self, time_old, values, time_new):
+        if self.method == 'spline' and time_old.shape[0] > 3:
+            from scipy.interpolate import CubicSpline
+            return CubicSpline(time_old, values, axis=0)(time_new)
+
+        # np.interp is 1D; loop over columns instead of rows
+        return np.column_stack([np.interp(time_new, time_old, values[:, i]) for i in range(values.shape[1])])
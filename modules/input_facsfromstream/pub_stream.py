@@ -0,0 +1,275 @@
+"""Publishes AU / head pose / eye gaze rows streamed by any tracker to FACSvatar
+
+Reads OpenFace-column csv rows or compact binary records from stdin, a named pipe (FIFO) or a local UDP socket
+and publishes every row as soon as it is received.
+
+csv: first line is the header (OpenFace column names), every next line 1 frame; a new header line resets columns
+bin: little-endian records of BIN_FORMAT; values in order of BIN_COLUMNS (AU values 0-5, as OpenFace outputs)
+
+Relies on Python 3.6+ due to async generator yield statement"""
+
+# Copyright (c) Stef van der Struijk
+# License: GNU Lesser General Public License
+
+
+import sys
+import argparse
+import time
+import json
+import struct
+import statistics
+import asyncio
+from collections import deque
+
+
+# FACSvatar imports; if statement for documentation
+if __name__ == '__main__':
+    sys.path.append("..")
+    # input_facsfromcsv imports with 'modules.' prefix
+    sys.path.append("../..")
+    from facsvatarzeromq import FACSvatarZeroMQ
+    from modules.input_facsfromcsv.openfacefiltercsv import FilterCSV
+    from modules.input_facsfromcsv.pub_facs import OpenFaceMessage
+else:
+    from modules.facsvatarzeromq import FACSvatarZeroMQ
+    from modules.input_facsfromcsv.openfacefiltercsv import FilterCSV
+    from modules.input_facsfromcsv.pub_facs import OpenFaceMessage
+
+
+# column order of binary records (after frame)
+BIN_COLUMNS = ['timestamp', 'confidence',
+               'AU01_r', 'AU02_r', 'AU04_r', 'AU05_r', 'AU06_r', 'AU07_r', 'AU09_r', 'AU10_r', 'AU12_r',
+               'AU14_r', 'AU15_r', 'AU17_r', 'AU20_r', 'AU23_r', 'AU25_r', 'AU26_r', 'AU45_r',
+               'pose_Rx', 'pose_Ry', 'pose_Rz', 'gaze_angle_x', 'gaze_angle_y']
+# frame: uint32, timestamp: float64, rest float32
+BIN_FORMAT = "<Id" + "f" * (len(BIN_COLUMNS) - 1)
+
+
+# puts received UDP datagrams in a queue
+class DatagramQueue(asyncio.DatagramProtocol):
+    def __init__(self, data_queue):
+        self.data_queue = data_queue
+
+    def datagram_received(self, data, addr):
+        self.data_queue.put_nowait((time.time(), data))
+
+
+# reads rows from stdin, FIFO or UDP
+class StreamSource:
+    """Yields (ingest time, row) for every csv line or binary record received"""
+
+    def __init__(self, source='stdin', data_format='csv'):
+        """
+        :param source: 'stdin', 'udp:<port>' or path to a named pipe (FIFO)
+        :param data_format: 'csv' for OpenFace-column rows, 'bin' for BIN_FORMAT records
+        """
+
+        self.source = source
+        self.data_format = data_format
+        self.record_size = struct.calcsize(BIN_FORMAT)
+
+    async def row_gen(self):
+        if self.source.startswith("udp:"):
+            gen = self.udp_gen(int(self.source[4:]))
+        else:
+            gen = self.pipe_gen()
+
+        async for t, row in gen:
+            yield t, row
+
+    # stdin / named pipe; one line or record at a time
+    async def pipe_gen(self):
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader()
+
+        if self.source == 'stdin':
+            pipe = sys.stdin.buffer
+        else:
+            # blocks until a writer opens the FIFO
+            print("Opening {}".format(self.source))
+            pipe = await loop.run_in_executor(None, open, self.source, 'rb', 0)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+
+        while True:
+            try:
+                if self.data_format == 'bin':
+                    row = await reader.readexactly(self.record_size)
+                else:
+                    row = await reader.readline()
+                    # end of stream
+                    if not row:
+                        return
+                    row = row.strip()
+                    if not row:
+                        continue
+
+            except asyncio.IncompleteReadError:
+                return
+
+            yield time.time(), row
+
+    # local UDP socket; a datagram may contain several lines / records
+    async def udp_gen(self, port):
+        loop = asyncio.get_event_loop()
+        data_queue = asyncio.Queue()
+        await loop.create_datagram_endpoint(lambda: DatagramQueue(data_queue), local_addr=('127.0.0.1', port))
+        print("Listening on udp://127.0.0.1:{}".format(port))
+
+        while True:
+            t, data = await data_queue.get()
+
+            if self.data_format == 'bin':
+                for i in range(0, len(data) - self.record_size + 1, self.record_size):
+                    yield t, data[i:i + self.record_size]
+            else:
+                for row in data.splitlines():
+                    row = row.strip()
+                    if row:
+                        yield t, row
+
+
+# normalises received rows into the same messages OpenFaceMessage produces
+class StreamMessage:
+    def __init__(self, source='stdin', data_format='csv', header=None):
+        """
+        :param source: see StreamSource
+        :param data_format: 'csv' or 'bin'
+        :param header: comma separated csv header, for trackers that don't send one
+        """
+
+        self.stream_source = StreamSource(source, data_format)
+        self.data_format = data_format
+        self.filter_csv = FilterCSV()
+        self.ofmsg = OpenFaceMessage()
+
+        self.col_keep = None
+        # False: header misses columns OpenFaceMessage needs; rows are skipped until a valid header
+        self.header_ok = True
+        if data_format == 'bin':
+            self.col_keep = self.filter_csv.header_keep(BIN_COLUMNS)
+        elif header:
+            self.set_header(header.split(","))
+
+    # columns OpenFaceMessage needs but not in header; gaze only as x and y pair
+    def missing_columns(self, col_keep):
+        cols = {c for i, c in col_keep}
+        missing = [c for c in ['timestamp'] if c not in cols]
+        if ('gaze_angle_x' in cols) != ('gaze_angle_y' in cols):
+            missing.append('gaze_angle_y' if 'gaze_angle_x' in cols else 'gaze_angle_x')
+
+        return missing
+
+    def set_header(self, header):
+        self.col_keep = self.filter_csv.header_keep(header)
+        missing = self.missing_columns(self.col_keep)
+        self.header_ok = not missing
+
+        if missing:
+            print("Header rejected, missing columns: {}; skipping rows until a valid header".format(missing))
+        else:
+            print("Header received, using columns: {}".format([c for i, c in self.col_keep]))
+
+    # yields ingest time and msg dict ('' when not enough confidence)
+    async def msg_gen(self):
+        frame = 0
+
+        async for t, row in self.stream_source.row_gen():
+            if self.data_format == 'bin':
+                frame, *values = struct.unpack(BIN_FORMAT, row)
+
+            else:
+                values = row.decode('utf-8').split(",")
+
+                # (new) header
+                if self.col_keep is None or not values[0].strip().replace('.', '', 1).isdigit():
+                    self.set_header(values)
+                    frame = 0
+                    continue
+
+                if not self.header_ok:
+                    continue
+
+            try:
+                self.ofmsg.set_msg_row(self.filter_csv.clean_row(self.col_keep, values, frame))
+            except (IndexError, ValueError):
+                print("Skipping row not matching header: {}".format(row))
+                continue
+
+            frame += 1
+            yield t, self.ofmsg.msg if 'au_r' in self.ofmsg.msg else ''
+
+        # stream ended
+        yield None, None
+
+
+class FACSvatarMessages(FACSvatarZeroMQ):
+    """Publishes FACS and Head movement data streamed over stdin, a FIFO or UDP"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stream_msg = StreamMessage(self.misc['source'], self.misc['format'], self.misc['header'])
+        self.topic = (self.pub_key + "." + self.misc['user'] + "." + self.misc['stream_name']).encode('ascii')
+        self.report_every = int(self.misc['report_every'])
+        # ingest-to-publish latency in ms of last messages
+        self.latency = deque(maxlen=self.report_every)
+
+    async def stream_pub(self):
+        msg_count = 0
+
+        async for t, msg in self.stream_msg.msg_gen():
+            # stream ended; tell network messages finished (timestamp == data == None)
+            if t is None:
+                print("Stream ended; FACS done")
+                await self.pub_socket.send_multipart([self.pub_key.encode('ascii'), b'', b''])
+                break
+
+            await self.pub_socket.send_multipart([self.topic,
+                                                  str(int(time.time() * 1000)).encode('ascii'),  # timestamp
+                                                  # '' when not enough confidence; b'' only ends the stream
+                                                  json.dumps(msg).encode('utf-8')
+                                                  ])
+            self.latency.append((time.time() - t) * 1000)
+
+            msg_count += 1
+            if msg_count % self.report_every == 0:
+                self.print_latency(msg_count)
+
+    def print_latency(self, msg_count):
+        lat = sorted(self.latency)
+        print("Messages: {}; ingest-to-publish latency (ms) mean: {:.3f}, median: {:.3f}, p99: {:.3f}, max: {:.3f}"
+              .format(msg_count, statistics.mean(lat), lat[len(lat) // 2], lat[int(len(lat) * .99)], lat[-1]))
+
+
+if __name__ == '__main__':
+    # command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pub_ip", default=argparse.SUPPRESS,
+                        help="IP (e.g. 192.168.x.x) of where to pub to; Default: 127.0.0.1 (local)")
+    parser.add_argument("--pub_port", default="5570",
+                        help="Port of where to pub to; Default: 5570")
+    parser.add_argument("--pub_key", default="openface",
+                        help="Key for filtering message; Default: openface")
+    parser.add_argument("--pub_bind", default=False,
+                        help="True: socket.bind() / False: socket.connect(); Default: False")
+    parser.add_argument("--source", default="stdin",
+                        help="stdin, udp:<port> or path to named pipe; Default: stdin")
+    parser.add_argument("--format", default="csv",
+                        help="csv: OpenFace-column rows, bin: binary records (see BIN_FORMAT); Default: csv")
+    parser.add_argument("--header", default=None,
+                        help="Comma separated csv header when the tracker doesn't send one; Default: None")
+    parser.add_argument("--user", default="p0",
+                        help="Participant key in topic; Default: p0")
+    parser.add_argument("--stream_name", default="stream",
+                        help="Name in topic, like csv file name for pub_facs; Default: stream")
+    parser.add_argument("--report_every", default="500",
+                        help="Print latency statistics every x messages; Default: 500")
+
+    args, leftovers = parser.parse_known_args()
+    print("The following arguments are used: {}".format(args))
+    print("The following arguments are ignored: {}\n".format(leftovers))
+
+    # init FACSvatar message class
+    facsvatar_messages = FACSvatarMessages(**vars(args))
+
+    # start processing messages; give list of functions to call async
+    facsvatar_messages.start([facsvatar_messages.stream_pub])
@@ -40,9 +40,11 @@ if __name__ == '__main__':
     sys.path.append("..")
     from facsvatarzeromq import FACSvatarZeroMQ
     from smooth_data import SmoothData
+    from bundlemsg import is_bundle, section_topic, BUNDLE_KEY
 else:
     from modules.facsvatarzeromq import FACSvatarZeroMQ
     from .smooth_data import SmoothData
+    from .bundlemsg import is_bundle, section_topic, BUNDLE_KEY
 
 
 class FACSvatarMessages(FACSvatarZeroMQ):
@@ -53,6 +55,8 @@ class FACSvatarMessages(FACSvatarZeroMQ):
 
         # keep dict of smooth object per topic
         self.smooth_obj_dict = {}
+        # topics of which multiplier still has to match number of AUs
+        self.new_smooth_topics = set()
 
     # # overwrite existing start function
     # def start(self, async_func_list=None):
@@ -121,6 +125,61 @@ class FACSvatarMessages(FACSvatarZeroMQ):
             
         return au_dict
 
+    # smooth data of a single participant; returns None when data shouldn't be forwarded
+    def smooth_msg(self, topic, data, apply_function):
+        # only pass on messages with enough tracking confidence; always send when no confidence param
+        if 'confidence' in data and data['confidence'] < 0.7:
+            return None
+
+        # don't smooth data with 'smooth' == False;
+        if 'smooth' not in data or data['smooth']:
+            # if topic changed, instantiate a new SmoothData object
+            if topic not in self.smooth_obj_dict:
+                self.smooth_obj_dict[topic] = SmoothData()
+                self.new_smooth_topics.add(topic)
+
+            # check au dict in data and not empty
+            if "au_r" in data and data['au_r']:
+                # convert gaze into AU 61, 62, 63, 64
+                if "gaze" in data:
+                    data['au_r'] = self.gaze_to_au(data['au_r'], data['gaze'])
+                    # remove from message after AU convert
+                    data.pop('gaze')
+
+                # sort dict; dicts keep insert order Python 3.6+
+                # au_r_dict = data['au_r']
+                data['au_r'] = dict(sorted(data['au_r'].items(), key=lambda k: k[0]))
+
+                # match number of multiplier columns:
+                if topic in self.new_smooth_topics:
+                    self.smooth_obj_dict[topic].set_new_multiplier(len(data['au_r']))
+                    self.new_smooth_topics.discard(topic)
+
+                # smooth facial expressions; window_size: number of past data points;
+                # steep: weight newer data
+                # data['au_r'] = smooth_func(au_r_sorted, queue_no=0, window_size=4, steep=.35)
+                data['au_r'] = getattr(self.smooth_obj_dict[topic], apply_function)(data['au_r'],
+                                                                                    queue_no=0,
+                                                                                    window_size=3,
+                                                                                    steep=.25)
+
+            # check head rotation dict in data and not empty
+            if "pose" in data and data['pose']:
+                # smooth head position
+                # data['pose'] = smooth_func(data['pose'], queue_no=1, window_size=4, steep=.2)
+                data['pose'] = getattr(self.smooth_obj_dict[topic], apply_function)(data['pose'], queue_no=1,
+                                                                                    window_size=6,
+                                                                                    steep=.15)
+
+                # TODO add eye direction AU data
+
+        else:
+            print("No smoothing applied, forwarding unchanged")
+            # remove topic from dict when msgs finish
+            print("Removing topic from smooth_obj_dict: {}".format(self.smooth_obj_dict.pop(topic, None)))
+
+        return data
+
     async def pub_sub_function(self, apply_function):  # async
         """Subscribes to FACS data, smooths, publishes it"""
 
@@ -129,8 +188,6 @@ class FACSvatarMessages(FACSvatarZeroMQ):
         # # get the function we need to pass data to
         # smooth_func = getattr(self.smooth_data, apply_function)
 
-        new_smooth_object = False
-
         # await messages
         print("Awaiting FACS data...")
         # without try statement, no error output
@@ -144,66 +201,29 @@ class FACSvatarMessages(FACSvatarZeroMQ):
                 # check not finished; timestamp is empty (b'')
                 if msg[1]:
                     msg[2] = json.loads(msg[2].decode('utf-8'))
-
-                    # only pass on messages with enough tracking confidence; always send when no confidence param
-                    if 'confidence' not in msg[2] or msg[2]['confidence'] >= 0.7:
-                        # subscription key / topic
-                        topic = msg[0].decode('ascii')
-
-                        # don't smooth data with 'smooth' == False;
-                        if 'smooth' not in msg[2] or msg[2]['smooth']:
-                            # if topic changed, instantiate a new SmoothData object
-                            if topic not in self.smooth_obj_dict:
-                                self.smooth_obj_dict[topic] = SmoothData()
-                                new_smooth_object = True
-
-                            # check au dict in data and not empty
-                            if "au_r" in msg[2] and msg[2]['au_r']:
-                                # convert gaze into AU 61, 62, 63, 64
-                                if "gaze" in msg[2]:
-                                    msg[2]['au_r'] = self.gaze_to_au(msg[2]['au_r'], msg[2]['gaze'])
-                                    # remove from message after AU convert
-                                    msg[2].pop('gaze')
-                            
-                                # sort dict; dicts keep insert order Python 3.6+
-                                # au_r_dict = msg[2]['au_r']
-                                msg[2]['au_r'] = dict(sorted(msg[2]['au_r'].items(), key=lambda k: k[0]))
-
-                                # match number of multiplier columns:
-                                if new_smooth_object:
-                                    self.smooth_obj_dict[topic].set_new_multiplier(len(msg[2]['au_r']))
-                                    new_smooth_object = False
-
-                                # smooth facial expressions; window_size: number of past data points;
-                                # steep: weight newer data
-                                # msg[2]['au_r'] = smooth_func(au_r_sorted, queue_no=0, window_size=4, steep=.35)
-                                msg[2]['au_r'] = getattr(self.smooth_obj_dict[topic], apply_function)(msg[2]['au_r'],
-                                                                                                      queue_no=0,
-                                                                                                      window_size=3,
-                                                                                                      steep=.25)
-
-                            # check head rotation dict in data and not empty
-                            if "pose" in msg[2] and msg[2]['pose']:
-                                # smooth head position
-                                # msg[2]['pose'] = smooth_func(msg[2]['pose'], queue_no=1, window_size=4, steep=.2)
-                                msg[2]['pose'] = getattr(self.smooth_obj_dict[topic], apply_function)(msg[2]['pose'], queue_no=1,
-                                                                                     window_size=6,
-                                                                                     steep=.15)
-
-                                # TODO add eye direction AU data
-
-                        else:
-                            print("No smoothing applied, forwarding unchanged")
-                            # remove topic from dict when msgs finish
-                            print("Removing topic from smooth_obj_dict: {}".format(self.smooth_obj_dict.pop(topic, None)))
-
-                        # send modified message
-                        print(msg)
-                        await self.pub_socket.send_multipart([msg[0],  # topic
-                                                              msg[1],  # timestamp
-                                                              # data in JSON format or empty byte
-                                                              json.dumps(msg[2]).encode('utf-8')
-                                                              ])
+                    # subscription key / topic
+                    topic = msg[0].decode('ascii')
+
+                    # all participants of 1 frame; smooth every participant in 1 pass with its own topic
+                    if is_bundle(msg[2]):
+                        for key, section in list(msg[2][BUNDLE_KEY].items()):
+                            if section:
+                                section = self.smooth_msg(section_topic(topic, key), section, apply_function)
+                                # not enough confidence; forward as empty data for this participant
+                                msg[2][BUNDLE_KEY][key] = section if section is not None else ''
+
+                    else:
+                        msg[2] = self.smooth_msg(topic, msg[2], apply_function)
+                        if msg[2] is None:
+                            continue
+
+                    # send modified message
+                    print(msg)
+                    await self.pub_socket.send_multipart([msg[0],  # topic
+                                                          msg[1],  # timestamp
+                                                          # data in JSON format or empty byte
+                                                          json.dumps(msg[2]).encode('utf-8')
+                                                          ])
 
                 # send message we're done
                 else:
@@ -0,0 +1,172 @@
+"""Generates DNN AU tracks of recorded (cleaned) OpenFace csv files, without replaying them in real time
+
+Eye gaze AUs are removed as in pub_deepfacs and every file is predicted in large batches:
+- default: every frame on its own (as pub_deepfacs)
+- --streaming True: recurrent model (numpy backend) runs over the whole file as 1 sequence; otherwise every frame
+  is predicted with the --window frames before it (as pub_deepfacs --streaming True)
+
+Saves <name>.csv (frame, timestamp, AU*_r) per input file in <csv folder>_dnn, so DNN output isn't replayed as
+input by pub_facs; files are spread over processes."""
+
+# Copyright (c) Stef van der Struijk
+# License: GNU Lesser General Public License
+
+
+import os
+import sys
+import argparse
+import time
+from os.path import join
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+# own imports; if statement for documentation
+if __name__ == '__main__':
+    sys.path.append("../..")
+    from modules.process_facsdnnfacs.pub_deepfacs import DeepFACSMsg, AU_GAZE
+else:
+    from .pub_deepfacs import DeepFACSMsg, AU_GAZE
+
+
+# model of this process; loaded once per process
+deepfacs = None
+
+
+def load_model(model_path, backend, streaming, window):
+    global deepfacs
+    deepfacs = DeepFACSMsg(model_path, backend, streaming, window)
+
+    # whole file as 1 sequence; output of every frame
+    if deepfacs.carry_state:
+        deepfacs.facs_model.return_sequences()
+
+
+# predict AUs of all frames; (frames, 17) --> (frames, 17)
+def predict_frames(au_array_val, batch_size):
+    facs_model = deepfacs.facs_model
+
+    if deepfacs.carry_state:
+        return facs_model.predict(au_array_val[np.newaxis])[0]
+
+    # frame + window - 1 frames before it; start padded with first frame (as InputWindow)
+    if deepfacs.window > 1:
+        padded = np.concatenate((np.repeat(au_array_val[:1], deepfacs.window - 1, axis=0), au_array_val))
+        inputs = np.lib.stride_tricks.sliding_window_view(padded, deepfacs.window, axis=0).transpose(0, 2, 1)
+    else:
+        inputs = au_array_val[:, np.newaxis]
+
+    deep_au_list = []
+    for i in range(0, len(inputs), batch_size):
+        deep_au_array_val = facs_model.predict(inputs[i:i + batch_size])
+        # output per timestep: newest frame
+        if deep_au_array_val.ndim == 3:
+            deep_au_array_val = deep_au_array_val[:, -1]
+        deep_au_list.append(deep_au_array_val.reshape(len(deep_au_array_val), -1))
+
+    return np.concatenate(deep_au_list)
+
+
+# cleaned csv --> output_dir/<name>.csv; returns (csv name, frames, seconds)
+def process_csv(csv_path, output_dir, batch_size):
+    time_start = time.time()
+    csv_path = Path(csv_path)
+
+    df = pd.read_csv(csv_path)
+    # AU**_r columns without eye gaze AUs
+    au_cols = [col for col in df.columns if col.startswith("AU") and col.endswith("_r")
+               and col[:-2] not in AU_GAZE]
+    # frames without tracking have no values
+    df = df.dropna(subset=au_cols)
+
+    # no tracked frames (e.g. header-only clean csv); header-only output
+    if df.empty:
+        df_dnn = pd.DataFrame(columns=['frame', 'timestamp'] + au_cols)
+        df_dnn.to_csv(Path(output_dir) / csv_path.name, index=False)
+        return csv_path.name, 0, time.time() - time_start
+
+    deep_au_array_val = predict_frames(df[au_cols].values.astype(np.float32), batch_size)
+
+    df_dnn = pd.DataFrame(deep_au_array_val, columns=au_cols, index=df.index)
+    df_dnn.insert(0, 'frame', df['frame'])
+    df_dnn.insert(1, 'timestamp', df['timestamp'])
+    df_dnn.to_csv(Path(output_dir) / csv_path.name, index=False)
+
+    return csv_path.name, len(df_dnn), time.time() - time_start
+
+
+def main(csv_paths, output_dir, model_path, backend, streaming, window, batch_size, processes):
+    time_start = time.time()
+    frame_total = 0
+    os.makedirs(output_dir, exist_ok=True)
+
+    failed = []
+
+    with ProcessPoolExecutor(processes or None, initializer=load_model,
+                             initargs=(model_path, backend, streaming, window)) as executor:
+        futures = [executor.submit(process_csv, csv_path, output_dir, batch_size) for csv_path in csv_paths]
+        for csv_path, future in zip(csv_paths, futures):
+            # 1 bad file doesn't stop the other files
+            try:
+                csv_name, frame_count, seconds = future.result()
+            except Exception as e:
+                print("{}: failed: {}".format(Path(csv_path).name, e))
+                failed.append(Path(csv_path).name)
+                continue
+
+            frame_total += frame_count
+            print("{}: {} frames in {:.2f} s ({:.0f} frames/s)".format(csv_name, frame_count, seconds,
+                                                                       frame_count / max(seconds, 1e-9)))
+
+    time_total = time.time() - time_start
+    print("\n{} files, {} frames in {:.2f} s ({:.0f} frames/s)".format(len(csv_paths), frame_total, time_total,
+                                                                     frame_total / time_total))
+    if failed:
+        print("Failed files: {}".format(failed))
+
+
+if __name__ == '__main__':
+    # command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv_dir", default=join("..", "input_facsfromcsv", "openface", "default_clean"),
+                        help="Folder with cleaned OpenFace csv files; Default: input_facsfromcsv/openface/"
+                             "default_clean")
+    parser.add_argument("--pattern", default="*.csv",
+                        help="Which csv files in --csv_dir; Default: *.csv")
+    parser.add_argument("--output_dir", default=argparse.SUPPRESS,
+                        help="Folder for generated csv files; Default: <csv_dir>_dnn")
+
+    # model; same as pub_deepfacs
+    parser.add_argument("--model", default=join("models", "mimicry_trained.h5"),
+                        help="Trained Keras .h5 model; Default: models/mimicry_trained.h5")
+    parser.add_argument("--backend", default="numpy",
+                        help="'numpy': forward pass in numpy, no TensorFlow needed / 'keras': Keras predict; "
+                             "Default: numpy")
+    parser.add_argument("--streaming", default=False,
+                        help="True: context between frames; recurrent model (numpy backend): whole file as 1 "
+                             "sequence, otherwise: predict on the last --window frames; Default: False")
+    parser.add_argument("--window", default="30",
+                        help="Frames per prediction when streaming without model state; Default: 30")
+
+    parser.add_argument("--batch_size", default="4096",
+                        help="Frames per predict (not used for 1 sequence per file); Default: 4096")
+    parser.add_argument("--processes", default="0",
+                        help="Files processed at the same time; Default: 0 (number of CPUs)")
+
+    args, leftovers = parser.parse_known_args()
+    print("The following arguments are used: {}".format(args))
+    print("The following arguments are ignored: {}\n".format(leftovers))
+
+    csv_paths = sorted(Path(args.csv_dir).glob(args.pattern))
+    if not csv_paths:
+        print("No csv files found in: {}".format(os.path.abspath(args.csv_dir)))
+        sys.exit(1)
+
+    # sibling folder; not found by pub_facs / catalog as replay input
+    csv_dir = Path(args.csv_dir).resolve()
+    output_dir = getattr(args, 'output_dir', str(csv_dir.parent / (csv_dir.name + "_dnn")))
+
+    main(csv_paths, output_dir, args.model, args.backend, args.streaming in (True, "True", "true", "1"), int(args.window),
+         int(args.batch_size), int(args.processes))
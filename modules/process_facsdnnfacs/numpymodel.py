@@ -0,0 +1,454 @@
+"""Runs a Keras model saved as .h5 with numpy only; no Keras / TensorFlow needed
+
+The model config and trained weights are read once with h5py. Supported layers: Dense, LSTM, GRU, SimpleRNN,
+TimeDistributed (of supported layers), BatchNormalization, Activation, LeakyReLU, Dropout (and other layers that do
+nothing at inference), in a Sequential model or a Functional model without branches.
+
+Recurrent layers can run incrementally: forward() takes and returns the state of every layer; states of several
+sequences are batched with stack_states() / split_states(). predict() always starts from zero state, also for
+stateful layers; pass states to forward() to carry them between calls.
+
+python numpymodel.py --validate  compares the output with Keras on frames of the bundled csv files"""
+
+# Copyright (c) Stef van der Struijk
+# License: GNU Lesser General Public License
+
+
+import sys
+import argparse
+import json
+import time
+from pathlib import Path
+import numpy as np
+import h5py
+
+
+def hard_sigmoid(x):
+    return np.clip(.2 * x + .5, 0., 1.)
+
+
+# Keras 3: relu6(x + 3) / 6
+def hard_sigmoid_v3(x):
+    return np.clip(x / 6 + .5, 0., 1.)
+
+
+def sigmoid(x):
+    return .5 * (np.tanh(.5 * x) + 1)
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def selu(x):
+    return 1.0507009873554805 * np.where(x > 0, x, 1.6732632423543772 * np.expm1(x))
+
+
+# Keras activation name: function
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'tanh': np.tanh,
+    'sigmoid': sigmoid,
+    'hard_sigmoid': hard_sigmoid,
+    'hard_sigmoid_v3': hard_sigmoid_v3,
+    'softmax': softmax,
+    'elu': lambda x: np.where(x > 0, x, np.expm1(x)),
+    'selu': selu,
+    'softplus': lambda x: np.logaddexp(x, 0),
+    'softsign': lambda x: x / (1 + np.abs(x)),
+    'exponential': np.exp,
+}
+
+# layers without effect at inference
+IDENTITY_LAYERS = {'InputLayer', 'Dropout', 'SpatialDropout1D', 'GaussianNoise', 'GaussianDropout', 'AlphaDropout',
+                   'ActivityRegularization'}
+
+
+def activation(name):
+    # newer Keras versions save activations as {'class_name': ..., 'config': ...}
+    if isinstance(name, dict):
+        name = name['config'].get('name', name['class_name'])
+    if name not in ACTIVATIONS:
+        raise NotImplementedError("Activation '{}' not supported".format(name))
+
+    return ACTIVATIONS[name]
+
+
+class Layer:
+    """Layer without weights or state"""
+
+    recurrent = False
+
+    def __init__(self, config, weights):
+        self.config = config
+        self.weights = weights
+
+    # x: (batch, [time,] features); state: only used by recurrent layers
+    def forward(self, x, state=None):
+        return x, None
+
+
+class Dense(Layer):
+    def __init__(self, config, weights):
+        super().__init__(config, weights)
+        self.kernel = weights['kernel']
+        self.bias = weights.get('bias')
+        self.activation = activation(config.get('activation', 'linear'))
+
+    def forward(self, x, state=None):
+        # applied to last axis, as Keras does for 3D input
+        y = x @ self.kernel
+        if self.bias is not None:
+            y += self.bias
+
+        return self.activation(y), None
+
+
+class Activation(Layer):
+    def __init__(self, config, weights):
+        super().__init__(config, weights)
+        self.activation = activation(config['activation'])
+
+    def forward(self, x, state=None):
+        return self.activation(x), None
+
+
+class LeakyReLU(Layer):
+    def forward(self, x, state=None):
+        # Keras 3 calls alpha negative_slope
+        slope = self.config.get('alpha', self.config.get('negative_slope', .3))
+        return np.where(x > 0, x, slope * x), None
+
+
+class BatchNormalization(Layer):
+    def __init__(self, config, weights):
+        super().__init__(config, weights)
+        # fold into 1 multiplication and addition
+        self.scale = weights.get('gamma', 1.) / np.sqrt(weights['moving_variance'] + config.get('epsilon', 1e-3))
+        self.shift = weights.get('beta', 0.) - weights['moving_mean'] * self.scale
+
+    def forward(self, x, state=None):
+        return x * self.scale + self.shift, None
+
+
+class Recurrent(Layer):
+    """Runs a cell over the time axis; state is carried between calls"""
+
+    recurrent = True
+
+    def __init__(self, config, weights):
+        super().__init__(config, weights)
+        self.units = config['units']
+        self.kernel = weights['kernel']
+        self.recurrent_kernel = weights['recurrent_kernel']
+        self.bias = weights.get('bias')
+        self.activation = activation(config.get('activation', 'tanh'))
+        self.return_sequences = config.get('return_sequences', False)
+        # Keras carries state between predict() calls; here only through forward() states (e.g. pub_deepfacs)
+        self.stateful = config.get('stateful', False)
+        self.go_backwards = config.get('go_backwards', False)
+        if self.go_backwards:
+            raise NotImplementedError("go_backwards not supported; state can't be carried between calls")
+
+    def initial_state(self, batch):
+        return (np.zeros((batch, self.units), dtype=self.kernel.dtype),)
+
+    def forward(self, x, state=None):
+        if state is None:
+            state = self.initial_state(x.shape[0])
+
+        # input projection of all timesteps at once
+        x_proj = x @ self.kernel
+        if self.bias is not None:
+            x_proj += self.input_bias()
+
+        y = []
+        for t in range(x.shape[1]):
+            state = self.step(x_proj[:, t], state)
+            y.append(state[0])
+
+        if self.return_sequences:
+            return np.stack(y, axis=1), state
+
+        return y[-1], state
+
+    def input_bias(self):
+        return self.bias
+
+
+class SimpleRNN(Recurrent):
+    def step(self, x_proj, state):
+        return (self.activation(x_proj + state[0] @ self.recurrent_kernel),)
+
+
+class LSTM(Recurrent):
+    def __init__(self, config, weights):
+        super().__init__(config, weights)
+        # Keras 2 default; tf.keras uses sigmoid
+        self.recurrent_activation = activation(config.get('recurrent_activation', 'hard_sigmoid'))
+
+    def initial_state(self, batch):
+        return (np.zeros((batch, self.units), dtype=self.kernel.dtype),) * 2
+
+    def step(self, x_proj, state):
+        h, c = state
+        z = x_proj + h @ self.recurrent_kernel
+
+        # gates in Keras order: input, forget, cell, output
+        u = self.units
+        i = self.recurrent_activation(z[:, :u])
+        f = self.recurrent_activation(z[:, u:2 * u])
+        c = f * c + i * self.activation(z[:, 2 * u:3 * u])
+        o = self.recurrent_activation(z[:, 3 * u:])
+
+        return o * self.activation(c), c
+
+
+class GRU(Recurrent):
+    def __init__(self, config, weights):
+        super().__init__(config, weights)
+        self.recurrent_activation = activation(config.get('recurrent_activation', 'hard_sigmoid'))
+        # reset_after: bias of input and of recurrent part separate (tf.keras default, CuDNN compatible)
+        self.reset_after = config.get('reset_after', False)
+
+    def input_bias(self):
+        return self.bias[0] if self.reset_after else self.bias
+
+    def step(self, x_proj, state):
+        h = state[0]
+        u = self.units
+
+        # gates in Keras order: update, reset, candidate
+        h_proj = h @ self.recurrent_kernel
+        if self.reset_after and self.bias is not None:
+            h_proj += self.bias[1]
+
+        z = self.recurrent_activation(x_proj[:, :u] + h_proj[:, :u])
+        r = self.recurrent_activation(x_proj[:, u:2 * u] + h_proj[:, u:2 * u])
+        if self.reset_after:
+            hh = self.activation(x_proj[:, 2 * u:] + r * h_proj[:, 2 * u:])
+        else:
+            hh = self.activation(x_proj[:, 2 * u:] + (r * h) @ self.recurrent_kernel[:, 2 * u:])
+
+        return (z * h + (1 - z) * hh,)
+
+
+class TimeDistributed(Layer):
+    def __init__(self, config, weights):
+        super().__init__(config, weights)
+        layer_config = config['layer']
+        self.layer = LAYERS[layer_config['class_name']](layer_config['config'], weights)
+        if self.layer.recurrent:
+            raise NotImplementedError("TimeDistributed of recurrent layers not supported")
+
+    def forward(self, x, state=None):
+        # supported layers work on the last axis; no reshaping needed
+        return self.layer.forward(x)
+
+
+# Keras class name: layer class
+LAYERS = {
+    'Dense': Dense,
+    'Activation': Activation,
+    'LeakyReLU': LeakyReLU,
+    'BatchNormalization': BatchNormalization,
+    'SimpleRNN': SimpleRNN,
+    'LSTM': LSTM,
+    'GRU': GRU,
+    'TimeDistributed': TimeDistributed,
+    **{name: Layer for name in IDENTITY_LAYERS},
+}
+
+
+class NumpyModel:
+    """Forward pass of a Keras .h5 model in numpy"""
+
+    def __init__(self, model_path):
+        with h5py.File(str(model_path), 'r') as f:
+            model_config = f.attrs['model_config']
+            if isinstance(model_config, bytes):
+                model_config = model_config.decode('utf-8')
+            # hard_sigmoid changed definition in Keras 3
+            keras_version = f.attrs.get('keras_version', b'2')
+            if isinstance(keras_version, bytes):
+                keras_version = keras_version.decode('utf-8')
+            if int(keras_version.split(".")[0]) >= 3:
+                model_config = model_config.replace('"hard_sigmoid"', '"hard_sigmoid_v3"')
+            model_config = json.loads(model_config)
+
+            weights_group = f['model_weights'] if 'model_weights' in f else f
+            self.layers = [LAYERS[layer_config['class_name']](layer_config['config'],
+                                                              self.layer_weights(weights_group, layer_config))
+                           for layer_config in self.layer_configs(model_config)
+                           if self.supported(layer_config)]
+
+        # state has to be carried between frames to get the trained behaviour
+        self.recurrent = any(layer.recurrent for layer in self.layers)
+
+    # layer configs in order of execution
+    @staticmethod
+    def layer_configs(model_config):
+        config = model_config['config']
+
+        # Sequential in Keras 2.0/2.1: list of layers
+        if isinstance(config, list):
+            return config
+
+        # Functional model: only a chain of layers (no branches)
+        if model_config['class_name'] != 'Sequential':
+            for layer_config in config['layers']:
+                nodes = layer_config.get('inbound_nodes', [])
+                # Keras 2: node is a list of inputs; Keras 3: {'args': [inputs], 'kwargs': ...}
+                if len(nodes) > 1 or any(len(node['args'] if isinstance(node, dict) else node) > 1
+                                         for node in nodes):
+                    raise NotImplementedError("Model with branches not supported: {}".format(layer_config['name']))
+
+        return config['layers']
+
+    @staticmethod
+    def supported(layer_config):
+        if layer_config['class_name'] not in LAYERS:
+            raise NotImplementedError("Layer '{}' not supported".format(layer_config['class_name']))
+
+        return layer_config['class_name'] != 'InputLayer'
+
+    # {'kernel': array, 'bias': array, ...} of a layer
+    @staticmethod
+    def layer_weights(weights_group, layer_config):
+        name = layer_config['config']['name']
+        if name not in weights_group:
+            return {}
+
+        group = weights_group[name]
+        weights = {}
+        for weight_name in group.attrs['weight_names']:
+            if isinstance(weight_name, bytes):
+                weight_name = weight_name.decode('utf-8')
+            # e.g. 'lstm_1/kernel:0' --> 'kernel'
+            weights[weight_name.split('/')[-1].split(':')[0]] = group[weight_name][()]
+
+        return weights
+
+    def forward(self, x, states=None):
+        """Output and state of every layer after running x
+
+        :param x: input of shape (batch, time, features)
+        :param states: states returned by previous call; None: start of sequence
+        :return: (output, states)
+        """
+
+        if states is None:
+            states = [None] * len(self.layers)
+
+        x = np.asarray(x, dtype=np.float32)
+        states_new = []
+        for layer, state in zip(self.layers, states):
+            x, state = layer.forward(x, state)
+            states_new.append(state)
+
+        return x, states_new
+
+    # same as Keras model.predict(); every sample starts without state
+    def predict(self, x):
+        return self.forward(x)[0]
+
+    # recurrent layers output every timestep; same output as running a sequence frame by frame
+    def return_sequences(self):
+        for layer in self.layers:
+            if layer.recurrent:
+                layer.return_sequences = True
+
+    # state of a new sequence; None for layers without state
+    def initial_states(self, batch=1):
+        return [layer.initial_state(batch) if layer.recurrent else None for layer in self.layers]
+
+    # states of separate sequences (e.g. 1 per user) --> states of 1 batch
+    @staticmethod
+    def stack_states(states_list):
+        return [None if states[0] is None else tuple(np.concatenate(arrays) for arrays in zip(*states))
+                for states in zip(*states_list)]
+
+    # states of 1 batch --> states of every sequence in it
+    @staticmethod
+    def split_states(states, batch):
+        return [[None if state is None else tuple(array[i:i + 1] for array in state) for state in states]
+                for i in range(batch)]
+
+
+# AU vectors of the bundled cleaned csv files; (frames, 17)
+def recorded_inputs(csv_dir):
+    import pandas as pd
+
+    au_list = []
+    for csv_path in sorted(Path(csv_dir).glob("*.csv")):
+        df = pd.read_csv(csv_path)
+        # frames without tracking have no values
+        au_list.append(df.loc[:, df.columns.str.contains("AU.*_r")].dropna().values)
+
+    return np.concatenate(au_list).astype(np.float32)
+
+
+def validate(model_path, csv_dir, tolerance):
+    """Compare numpy and Keras output; returns True when max absolute difference within tolerance"""
+
+    time_start = time.time()
+    numpy_model = NumpyModel(model_path)
+    print("numpy model loaded in {:.3f} s".format(time.time() - time_start))
+
+    time_start = time.time()
+    import keras
+    keras_model = keras.models.load_model(str(model_path))
+    print("Keras model loaded in {:.3f} s".format(time.time() - time_start))
+
+    au_v = recorded_inputs(csv_dir)
+    print("Recorded inputs: {}".format(au_v.shape))
+
+    # as pub_deepfacs feeds frames: (frames, 1, 17)
+    inputs = {'frames': au_v[:, np.newaxis]}
+    # whole sequence; recurrent state carried over frames
+    if numpy_model.recurrent:
+        inputs['sequence'] = au_v[np.newaxis, :500]
+
+    valid = True
+    for name, x in inputs.items():
+        y_keras = keras_model.predict(x, verbose=0)
+        y_numpy = numpy_model.predict(x)
+        diff = np.abs(y_keras - y_numpy).max()
+        valid &= bool(diff <= tolerance)
+        print("{}: max abs difference {:.2e} ({})".format(name, diff, "ok" if diff <= tolerance else "FAILED"))
+
+    # per frame latency
+    frame = au_v[np.newaxis, :1]
+    for name, predict in [('numpy', numpy_model.predict), ('Keras', lambda x: keras_model.predict(x, verbose=0))]:
+        time_start = time.perf_counter()
+        for _ in range(100):
+            predict(frame)
+        print("{} predict 1 frame: {:.3f} ms".format(name, (time.perf_counter() - time_start) * 10))
+
+    return valid
+
+
+if __name__ == '__main__':
+    # command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="models/mimicry_trained.h5",
+                        help="Keras .h5 model; Default: models/mimicry_trained.h5")
+    parser.add_argument("--validate", default=False, action='store_true',
+                        help="Compare output with Keras (needs Keras) on recorded frames")
+    parser.add_argument("--csv_dir", default="../input_facsfromcsv/openface/default_clean",
+                        help="Folder with cleaned csv files used as recorded inputs; Default: default_clean")
+    parser.add_argument("--tolerance", default="1e-4",
+                        help="Max absolute difference with Keras; Default: 1e-4")
+
+    args, leftovers = parser.parse_known_args()
+    print("The following arguments are used: {}".format(args))
+    print("The following arguments are ignored: {}\n".format(leftovers))
+
+    if args.validate:
+        sys.exit(0 if validate(args.model, args.csv_dir, float(args.tolerance)) else 1)
+
+    model = NumpyModel(args.model)
+    print("Layers: {}".format([type(layer).__name__ for layer in model.layers]))
+    print("Recurrent: {}".format(model.recurrent))
@@ -6,13 +6,17 @@ import os
 import sys
 import argparse
 import json
+import time
+import re
 from os.path import join
 import numpy as np
 import pandas as pd
 #import tensorflow as tf
-import keras
 import traceback
 import logging
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import zmq.asyncio
 
 
@@ -20,79 +24,236 @@ import zmq.asyncio
 if __name__ == '__main__':
     sys.path.append("..")
     from facsvatarzeromq import FACSvatarZeroMQ
+    from bundlemsg import is_bundle, unbundle, BUNDLE_KEY
+    from numpymodel import NumpyModel
 else:
     from modules.facsvatarzeromq import FACSvatarZeroMQ
+    from modules.bundlemsg import is_bundle, unbundle, BUNDLE_KEY
+    from .numpymodel import NumpyModel
+
+
+# eye gaze AUs; not used by the DNN
+AU_GAZE = ('AU61', 'AU62', 'AU63', 'AU64')
+
+
+# last frames of a stream in a ring buffer
+class InputWindow:
+    def __init__(self, size, frame):
+        # start filled with the first frame
+        self.frames = np.tile(frame, (size, 1))
+        self.pos = 0
+
+    # add frame; returns window from oldest to newest frame
+    def push(self, frame):
+        self.frames[self.pos] = frame
+        self.pos = (self.pos + 1) % len(self.frames)
+
+        return np.concatenate((self.frames[self.pos:], self.frames[:self.pos]))
 
 
 # process everything that is received
 class DeepFACSMsg:
-    def __init__(self):
-        # load Keras model
-        self.facs_model = keras.models.load_model(join("models", "mimicry_trained.h5"))
+    def __init__(self, model_path=join("models", "mimicry_trained.h5"), backend="numpy", streaming=False,
+                 window=1, cache_resolution=0, cache_size=1024, cache_check_every=100, context_max=64,
+                 context_idle=2):
+        # backend: 'numpy' (no TensorFlow needed) or 'keras'
+        if backend == "keras":
+            # load Keras model
+            import keras
+            self.facs_model = keras.models.load_model(model_path)
+        else:
+            self.facs_model = NumpyModel(model_path)
+
+        # stateful model (Keras carries state between predict calls): numpy backend carries state per topic
+        if backend != "keras" and any(getattr(layer, 'stateful', False) for layer in self.facs_model.layers):
+            print("Stateful model; streaming inference with model state per topic")
+            streaming = True
+
+        # streaming: keep context between frames of the same topic
+        # recurrent numpy model: carry layer states; otherwise: predict on the last `window` frames
+        self.carry_state = streaming and backend != "keras" and self.facs_model.recurrent
+        self.window = int(window) if streaming and not self.carry_state else 1
+        # topic: layer states / InputWindow; least recently used first
+        self.topic_context = OrderedDict()
+        # topic: time of last frame; context unused for context_idle seconds belongs to an earlier stream
+        self.context_time = {}
+        self.context_max = int(context_max)
+        self.context_idle = float(context_idle)
+        if streaming:
+            print("Streaming inference: {}".format("carrying model state" if self.carry_state else
+                                                   "window of {} frames".format(self.window)))
+
+        # prediction cache: input AUs rounded to cache_resolution --> output; least recently used dropped first
+        self.cache = None
+        self.cache_resolution = float(cache_resolution)
+        self.cache_size = int(cache_size)
+        # every n-th hit also predicted to measure error of cached output
+        self.cache_check_every = int(cache_check_every)
+        self.cache_lookups = 0
+        self.cache_hits = 0
+        self.cache_errors = []
+        if self.cache_resolution > 0:
+            # output depends on more than the current frame
+            if streaming or any(getattr(layer, 'stateful', False) for layer in self.facs_model.layers):
+                print("Prediction cache not enabled; only for stateless models (no --streaming)")
+            else:
+                self.cache = OrderedDict()
+                print("Prediction cache: resolution {}, size {}".format(self.cache_resolution, self.cache_size))
+
+    # predict dummy frames once, so the first real frames aren't slowed down (e.g. Keras graph building)
+    # raises ValueError if the model doesn't give 17 finite AU values per frame
+    def warmup(self, batch_size=1):
+        au_dicts = [{"AU{:02d}".format(i): 0. for i in range(17)} for _ in range(batch_size)]
+        topics = ["warmup.{}".format(i).encode('ascii') for i in range(batch_size)]
+        deep_au_dicts = self.deep_facs_batch(au_dicts, topics)
+
+        deep_au_values = [list(deep_au_dict.values()) for deep_au_dict in deep_au_dicts]
+        if any(len(values) != 17 for values in deep_au_values) or not np.isfinite(deep_au_values).all():
+            raise ValueError("Model output is not 17 finite AU values per frame")
+
+        # dummy frames are no stream and shouldn't be in cache or statistics
+        self.reset()
+        if self.cache is not None:
+            self.cache.clear()
+            self.cache_report()
+
+    # forget context of a topic and its sub topics (e.g. b'dnn.openface' of b'dnn.openface.p0.name'); None: all
+    def reset(self, topic=None):
+        if topic is None:
+            self.topic_context.clear()
+            self.context_time.clear()
+            return
+
+        for tp in [tp for tp in self.topic_context if tp == topic or tp.startswith(topic + b".")]:
+            del self.topic_context[tp]
+            del self.context_time[tp]
+
+    # context of a topic; None when new or idle too long (end of stream message might not be received)
+    def get_context(self, topic):
+        if topic in self.topic_context and time.time() - self.context_time[topic] > self.context_idle:
+            self.reset(topic)
+
+        return self.topic_context.get(topic)
+
+    # store context as most recently used; drop least recently used above context_max
+    def set_context(self, topic, context):
+        self.topic_context[topic] = context
+        self.topic_context.move_to_end(topic)
+        self.context_time[topic] = time.time()
+
+        while len(self.topic_context) > self.context_max:
+            del self.context_time[self.topic_context.popitem(last=False)[0]]
 
     async def facs_deep_facs(self, au_dict):  # , id_cb, type_cb
         """Receives a dict of AUs, returns a dict of deep generated AUs"""
 
-        # TODO invert process by only keeping trained AU
-        # temporary remove eye gaze AU data
-        au_gaze = ('AU61', 'AU62', 'AU63', 'AU64')
-        au_gaze_dict = {k: au_dict.pop(k) for k in au_gaze if k in au_dict}
-
-        # for au in :
-        #     if au in au_dict:
-        #         au_gaze
+        return (await self.facs_deep_facs_batch([au_dict]))[0]
 
-        # print()
-        # print(au_dict)
-        # print(type(au_dict))
+    async def facs_deep_facs_batch(self, au_dicts, topics=None):
+        """Receives a list of AU dicts, returns a list of deep generated AU dicts; 1 predict for all frames
 
-        #   get values for prediction
-        # cast json to pandas series
-        # au_df = pd.DataFrame.from_dict(au_dict)
-        # print(au_df)
-        # print(au_df.values)
+        topics: stream (unique) of every frame; only needed for streaming inference"""
 
-        # au_series = pd.Series(au_dict)
-        # print(au_series)
-        # print(au_series.values)
+        return self.deep_facs_batch(au_dicts, topics)
 
-        # au_df = pd.DataFrame.from_dict(au_dict, orient='index')
-        # deep_au_array_val = self.facs_model.predict(au_df.values)
-        # print(deep_au_array_val)
+    # blocking; call from an executor to keep the event loop free
+    def deep_facs_batch(self, au_dicts, topics=None):
+        au_keys = []
+        au_array_val = np.empty((len(au_dicts), 17))
+        for i, au_dict in enumerate(au_dicts):
+            # TODO invert process by only keeping trained AU
+            # temporary remove eye gaze AU data
+            for k in AU_GAZE:
+                au_dict.pop(k, None)
 
-        # dict to numpy
-        au_array_key = np.fromiter(au_dict.keys(), dtype='S16')
-        au_array_val = np.fromiter(au_dict.values(), dtype=float)
+            # dict to numpy
+            au_keys.append(list(au_dict.keys()))
+            au_array_val[i] = np.fromiter(au_dict.values(), dtype=float, count=17)
 
         # predict
-        # print()
-        # print(au_array_val)
-        # au_array_val_t = au_array_val[np.newaxis]
-        # print(au_array_val_t)
-        # print(au_array_val_t.shape)
-
-        au_array_val = au_array_val.reshape(1, 1, 17)
         #with tf.device('/gpu:0'):
-        deep_au_array_val = self.facs_model.predict(au_array_val)  # [np.newaxis]
-        # print()dd ignored file
+        if self.carry_state:
+            deep_au_array_val = self.predict_state(au_array_val, topics)
+        elif self.window > 1:
+            deep_au_array_val = self.predict_window(au_array_val, topics)
+        elif self.cache is not None:
+            deep_au_array_val = self.predict_cached(au_array_val)
+        else:
+            deep_au_array_val = self.facs_model.predict(au_array_val[:, np.newaxis])
         print(deep_au_array_val)
-        # print(np.asarray(deep_au_array_val))
-
-        # cast into dict format
-        # print()
-        print(np.squeeze(deep_au_array_val))
-        deep_au_dict = dict(zip(au_array_key, np.squeeze(deep_au_array_val).tolist()))
-        print(deep_au_dict)
-        # change key type from byte to string
-        deep_au_dict = {k.decode("utf-8"): v for k, v in deep_au_dict.items()}
-        # print(deep_au_dict)
-
-        print("\n")
-        #print(au_dict)
-        print(deep_au_dict)
 
-        # add gaze AUs back into dict and return
-        return deep_au_dict  # {**deep_au_dict, **au_gaze_dict}
+        # cast into dict format; 1 row per frame
+        deep_au_array_val = deep_au_array_val.reshape(len(au_dicts), -1).tolist()
+        deep_au_dicts = [dict(zip(keys, values)) for keys, values in zip(au_keys, deep_au_array_val)]
+        print(deep_au_dicts)
+
+        return deep_au_dicts
+
+    # 1 timestep per topic, continuing from the topic's previous state
+    def predict_state(self, au_array_val, topics):
+        states = self.facs_model.stack_states([self.get_context(topic) or self.facs_model.initial_states()
+                                               for topic in topics])
+        deep_au_array_val, states = self.facs_model.forward(au_array_val[:, np.newaxis], states)
+        for topic, topic_states in zip(topics, self.facs_model.split_states(states, len(topics))):
+            self.set_context(topic, topic_states)
+
+        return deep_au_array_val
+
+    # only frames not seen before (within cache resolution) are predicted
+    def predict_cached(self, au_array_val):
+        keys = [row.tobytes() for row in np.round(au_array_val / self.cache_resolution).astype(np.int64)]
+        deep_rows = [self.cache.get(key) for key in keys]
+        misses = [i for i, deep_row in enumerate(deep_rows) if deep_row is None]
+
+        hits = [i for i, deep_row in enumerate(deep_rows) if deep_row is not None]
+        for i in hits:
+            self.cache.move_to_end(keys[i])
+        # sample of hits also predicted, to compare with cached output
+        checks = [i for n, i in enumerate(hits, self.cache_hits + 1) if n % self.cache_check_every == 0]
+        self.cache_lookups += len(keys)
+        self.cache_hits += len(hits)
+
+        if misses or checks:
+            predicted = self.facs_model.predict(au_array_val[misses + checks, np.newaxis])
+            predicted = predicted.reshape(len(misses) + len(checks), -1)
+
+            for i, deep_row in zip(misses, predicted):
+                deep_rows[i] = deep_row
+                self.cache[keys[i]] = deep_row
+            for i, deep_row in zip(checks, predicted[len(misses):]):
+                self.cache_errors.append(np.abs(deep_rows[i] - deep_row).max())
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return np.array(deep_rows)
+
+    # hit rate and max abs error of checked hits since last call
+    def cache_report(self):
+        report = "cache hit rate {:.1%} ({} entries), error {}".format(
+            self.cache_hits / max(self.cache_lookups, 1), len(self.cache),
+            "{:.4f} mean / {:.4f} max".format(np.mean(self.cache_errors), np.max(self.cache_errors))
+            if self.cache_errors else "not checked yet")
+        self.cache_lookups = 0
+        self.cache_hits = 0
+        self.cache_errors = []
+
+        return report
+
+    # last `window` frames per topic as 1 sequence
+    def predict_window(self, au_array_val, topics):
+        windows = np.empty((len(topics), self.window, au_array_val.shape[1]))
+        for i, topic in enumerate(topics):
+            input_window = self.get_context(topic) or InputWindow(self.window, au_array_val[i])
+            windows[i] = input_window.push(au_array_val[i])
+            self.set_context(topic, input_window)
+
+        deep_au_array_val = self.facs_model.predict(windows)
+        # output per timestep: newest frame
+        if deep_au_array_val.ndim == 3:
+            deep_au_array_val = deep_au_array_val[:, -1]
+
+        return deep_au_array_val
 
 
 # client to message broker server
@@ -101,10 +262,61 @@ class FACSvatarMessages(FACSvatarZeroMQ):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.deepfacs = DeepFACSMsg()
-
-    # receiving data
-    async def deep_sub_pub(self):
+        self.model_path = self.misc.get('model', join("models", "mimicry_trained.h5"))
+        # everything except model path; same settings for swapped in models
+        self.deepfacs_settings = (self.misc.get('backend', "numpy"),
+                                  self.misc.get('streaming', False) in (True, "True", "true", "1"),
+                                  self.misc.get('window', 30),
+                                  self.misc.get('cache_resolution', 0),
+                                  self.misc.get('cache_size', 1024),
+                                  self.misc.get('cache_check_every', 100),
+                                  self.misc.get('context_max', 64),
+                                  self.misc.get('context_idle', 2))
+        self.deepfacs = DeepFACSMsg(self.model_path, *self.deepfacs_settings)
+        # new models are loaded next to inference; swapped in between batches
+        self.load_executor = ThreadPoolExecutor(max_workers=1)
+        # users to forget streaming context of before next batch (unsubscribed users)
+        self.reset_users = set()
+
+        # seconds to wait for more frames (other users) before predicting; 0: only frames already waiting
+        self.batch_window = float(self.misc.get('batch_window', 0)) / 1000
+        # max frames per predict
+        self.batch_max = int(self.misc.get('batch_max', 16))
+
+        # frames waiting for inference; topic: latest message (older frames of a topic are skipped)
+        self.pending = OrderedDict()
+        self.pending_max = int(self.misc.get('queue_max', 64))
+        self.pending_event = asyncio.Event()
+        # inference in its own thread; event loop keeps receiving messages and commands
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # (frames, predict seconds, queue depth) per batch since last report
+        self.batch_stats = []
+        # frames replaced by a newer frame of the same topic / dropped because queue was full
+        self.skipped = 0
+        self.dropped = 0
+        self.report_every = float(self.misc.get('report_every', 5))
+        self.time_report = time.time()
+
+        # users (e.g. 'p0') of which FACS data is subscribed; position of user in sub_key, e.g. openface.p0
+        self.sub_key_split = self.sub_key.split(".")
+        user_indices = [i for i, key in enumerate(self.sub_key_split) if re.fullmatch(r"p\d+", key)]
+        self.user_index = user_indices[0] if user_indices else None
+        self.users = {self.sub_key_split[self.user_index]} if user_indices else set()
+        # subscriptions match by prefix: 'openface.p1' would also receive p10, p11, ..
+        if self.users and self.user_sub_key(next(iter(self.users))) != self.sub_key:
+            self.sub_socket.setsockopt(zmq.UNSUBSCRIBE, self.sub_key.encode('ascii'))
+            self.sub_socket.setsockopt(zmq.SUBSCRIBE, self.user_sub_key(next(iter(self.users))).encode('ascii'))
+        # serve more users than the one in sub_key
+        if self.misc.get('users'):
+            self.set_users({user.strip() for user in self.misc['users'].split(",")})
+        # pub_facs --bundle publishes all users of a frame on 1 topic, e.g. openface.bundle.<group>
+        if self.user_index is not None:
+            self.sub_socket.setsockopt(zmq.SUBSCRIBE, ".".join(self.sub_key_split[:self.user_index] +
+                                                               [BUNDLE_KEY, ""]).encode('ascii'))
+
+    # receiving data; only latest frame per topic waits for inference
+    async def deep_sub(self):
         # keep listening to all published message on topic 'facs'
         while True:
             msg = await self.sub_socket.recv_multipart()
@@ -113,29 +325,117 @@ class FACSvatarMessages(FACSvatarZeroMQ):
             # if pub key is specified
             # if self.pub_key:
             #     msg[0] = self.pub_key.encode('utf-8')
-            
-            msg[0] = ("dnn." + msg[0].decode('ascii')).encode('ascii')
-
-            # check not finished; timestamp is empty (b'')
-            if msg[1]:
-                # process message
-                msg[2] = json.loads(msg[2].decode('utf-8'))
-                # generate Action Units based on user Action Units
-                msg[2]['au_r'] = await self.deepfacs.facs_deep_facs(msg[2]['au_r'])
-
-                # async always needs `send_multipart()`
-                # print(msg)
-
-                await self.pub_socket.send_multipart([msg[0],  # topic / key
-                                          msg[1],  # timestamp
-                                          # data in JSON format or empty byte
-                                          json.dumps(msg[2]).encode('utf-8')
-                                          ])
-
-            # send message we're done
-            else:
-                print("No more messages to publish; Deep FACS done")
-                await self.pub_socket.send_multipart([msg[0], b'', b''])
+
+            # all participants of 1 frame (pub_facs --bundle); DNN per participant
+            if msg[1] and BUNDLE_KEY in msg[0].decode('ascii').split("."):
+                data = json.loads(msg[2].decode('utf-8'))
+                if is_bundle(data):
+                    for topic, section in unbundle(msg[0].decode('ascii'), data):
+                        self.queue_msg([topic.encode('ascii'), msg[1], section])
+                    continue
+
+            self.queue_msg(msg)
+
+    # only latest frame per topic waits; msg[2]: JSON bytes or already decoded data
+    def queue_msg(self, msg):
+        msg[0] = ("dnn." + msg[0].decode('ascii')).encode('ascii')
+
+        # not a served user (e.g. frame still underway after unsubscribing); end of stream (b'') always passed
+        if msg[1] and self.user_index is not None and self.topic_user(msg[0]) not in self.users:
+            return
+
+        # latest wins; keep place in queue
+        if msg[0] in self.pending:
+            self.skipped += 1
+        # bounded queue: drop oldest topic
+        elif len(self.pending) >= self.pending_max:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+
+        self.pending[msg[0]] = msg
+        self.pending_event.set()
+
+    # predict waiting frames in batches (off the event loop); publish in order of arrival
+    async def deep_infer(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await self.pending_event.wait()
+
+            # no inference running; safe to change context
+            if self.reset_users:
+                for topic in [topic for topic in self.deepfacs.topic_context
+                              if self.topic_user(topic) in self.reset_users]:
+                    self.deepfacs.reset(topic)
+                self.reset_users = set()
+
+            # collect frames of other users; waiting adds latency, bigger batches throughput
+            if self.batch_window and len(self.pending) < self.batch_max:
+                await asyncio.sleep(self.batch_window)
+
+            queue_depth = len(self.pending)
+            msgs = [self.pending.popitem(last=False)[1] for _ in range(min(self.batch_max, len(self.pending)))]
+            if not self.pending:
+                self.pending_event.clear()
+
+            frames = []
+            topics = []
+            for msg in msgs:
+                # check not finished; timestamp is empty (b'')
+                if msg[1]:
+                    # process message; sections of a bundle are already decoded
+                    if isinstance(msg[2], bytes):
+                        msg[2] = json.loads(msg[2].decode('utf-8'))
+                    # not enough confidence ('') is passed on unchanged
+                    if isinstance(msg[2], dict) and msg[2].get('au_r'):
+                        frames.append(msg[2])
+                        topics.append(msg[0])
+
+            # generate Action Units based on user Action Units
+            if frames:
+                time_start = time.time()
+                deep_au_dicts = await loop.run_in_executor(self.executor, self.deepfacs.deep_facs_batch,
+                                                           [data['au_r'] for data in frames], topics)
+                for data, deep_au_dict in zip(frames, deep_au_dicts):
+                    data['au_r'] = deep_au_dict
+                self.track_batch(len(frames), time.time() - time_start, queue_depth)
+
+            for msg in msgs:
+                if msg[1]:
+                    # async always needs `send_multipart()`
+                    await self.pub_socket.send_multipart([msg[0],  # topic / key
+                                                          msg[1],  # timestamp
+                                                          # data in JSON format or empty byte
+                                                          json.dumps(msg[2]).encode('utf-8')
+                                                          ])
+
+                # send message we're done
+                else:
+                    print("No more messages to publish; Deep FACS done")
+                    await self.pub_socket.send_multipart([msg[0], b'', b''])
+                    # next stream on this topic (and its sub topics) starts without context
+                    self.deepfacs.reset(msg[0])
+
+    # print frames/s, batch size, queue depth and inference time every report_every seconds
+    def track_batch(self, frame_count, predict_time, queue_depth):
+        self.batch_stats.append((frame_count, predict_time, queue_depth))
+
+        time_now = time.time()
+        if time_now - self.time_report >= self.report_every:
+            frame_total = sum(n for n, _, _ in self.batch_stats)
+            predict_times = [t for _, t, _ in self.batch_stats]
+            print("Deep FACS: {:.1f} frames/s, {:.2f} frames per batch, inference {:.2f} ms mean / {:.2f} ms max "
+                  "per batch, queue depth {:.1f} mean / {} max, {} skipped (newer frame), {} dropped (queue full)"
+                  .format(frame_total / (time_now - self.time_report), frame_total / len(self.batch_stats),
+                          sum(predict_times) / len(predict_times) * 1000, max(predict_times) * 1000,
+                          sum(d for _, _, d in self.batch_stats) / len(self.batch_stats),
+                          max(d for _, _, d in self.batch_stats), self.skipped, self.dropped))
+            if self.deepfacs.cache is not None:
+                print("Deep FACS: {}".format(self.deepfacs.cache_report()))
+            self.batch_stats = []
+            self.skipped = 0
+            self.dropped = 0
+            self.time_report = time_now
 
     # receiving commands
     async def set_parameters(self):
@@ -144,8 +444,11 @@ class FACSvatarMessages(FACSvatarZeroMQ):
                 [id_dealer, topic, data] = await self.rout_socket.recv_multipart()
                 print("\nCommand received from '{}', with topic '{}' and msg '{}'".format(id_dealer, topic, data))
 
+                # load other model file; inference continues with current model until loaded
+                if topic.decode('ascii') == "dnn_model":
+                    asyncio.ensure_future(self.swap_model(data.decode('utf-8')))
                 # set subscriber key
-                if topic.decode('ascii').startswith("dnn"):
+                elif topic.decode('ascii').startswith("dnn"):
                     # await self.change_user()
                     await self.set_subscriber(data.decode('utf-8'))
                 else:
@@ -157,49 +460,99 @@ class FACSvatarMessages(FACSvatarZeroMQ):
                 logging.error(traceback.format_exc())
                 print()
 
-    # change user for what FACS data to subscribe (p0 or p1); 2 speakers only for now
+    # load and warm up model in background; keep current model if that fails
+    async def swap_model(self, model_path):
+        print("Loading model: {}".format(model_path))
+        time_start = time.time()
+
+        try:
+            deepfacs = await asyncio.get_event_loop().run_in_executor(self.load_executor, self.load_deepfacs,
+                                                                      model_path)
+        except Exception:
+            print("Loading model {} failed; keep using model: {}".format(model_path, self.model_path))
+            logging.error(traceback.format_exc())
+            return
+
+        # batch in progress finishes with old model; next batch uses new model without context of old model
+        self.deepfacs = deepfacs
+        self.model_path = model_path
+        self.reset_users = set()
+        print("Model swapped to {} in {:.0f} ms (load + warm-up)".format(model_path, (time.time() - time_start) * 1000))
+
+    # blocking; runs in load executor
+    def load_deepfacs(self, model_path):
+        deepfacs = DeepFACSMsg(model_path, *self.deepfacs_settings)
+        deepfacs.warmup(self.batch_max)
+
+        return deepfacs
+
+    # swap between 2 speakers (p0 <--> p1)
     async def change_user(self):
-        print("Changing subscription key from: {}".format(self.sub_key))
-        # unsubscribe all keys
-        self.sub_socket.setsockopt(zmq.UNSUBSCRIBE, self.sub_key.encode('ascii'))
-        # subscribe to new key
-        if "p0" in self.sub_key.split("."):
-            self.sub_key = self.sub_key.replace(".p0", ".p1")
-        elif "p1" in self.sub_key.split("."):
-            self.sub_key = self.sub_key.replace(".p1", ".p0")
-        self.sub_socket.setsockopt(zmq.SUBSCRIBE, self.sub_key.encode('ascii'))
-        print("Changed subscription key to: {}".format(self.sub_key))
-
-    # change to what FACS data to subscribe
-    async def set_subscriber(self, user_key):
-        print("Current subscription key: {}".format(self.sub_key))
-
-        # get individual topics
-        split_key = self.sub_key.split(".")
-
-        # if not in current subscription, change subscription
-        if user_key not in split_key:
-            # TODO not 2 participants
-            if user_key == "p0":
-                user_key_old = "p1"
-            elif user_key == "p1":
-                user_key_old = "p0"
-            else:
-                print("user_key is not p0 or p1")
-
-            # unsubscribe all keys
-            self.sub_socket.setsockopt(zmq.UNSUBSCRIBE, self.sub_key.encode('ascii'))
-
-            # change p0 to p1 or reversed
-            split_key[split_key.index(user_key_old)] = user_key
-
-            # set new subscription key
-            self.sub_key = ".".join(split_key)
-            self.sub_socket.setsockopt(zmq.SUBSCRIBE, self.sub_key.encode('ascii'))
-            print("Changed subscription key to: {}".format(self.sub_key))
-
-        else:
-            print("Already subscribed to user: {}".format(user_key))
+        swap = {"p0": "p1", "p1": "p0"}
+        self.set_users({swap.get(user, user) for user in self.users})
+
+    # change for which users FACS data is subscribed
+    # 'p2': only p2 (previous users unsubscribed); '+p2': add p2; '-p1': remove p1; comma separated: e.g. 'p0,p1'
+    async def set_subscriber(self, user_command):
+        users = set(self.users)
+
+        commands = [command.strip() for command in user_command.split(",") if command.strip()]
+        new_users = {command for command in commands if command[0] not in "+-"}
+        if new_users:
+            users = new_users
+        for command in commands:
+            if command[0] == "+":
+                users.add(command[1:])
+            elif command[0] == "-":
+                users.discard(command[1:])
+
+        self.set_users(users)
+
+    # (un)subscribe only changed users; frames and context of removed users are discarded
+    def set_users(self, users):
+        if self.user_index is None:
+            print("No user in sub_key (e.g. openface.p0); users can't be changed")
+            return
+
+        print("Current users: {}".format(sorted(self.users)))
+        removed = self.users - users
+        added = users - self.users
+
+        if not removed and not added:
+            print("Already subscribed to users: {}".format(sorted(users)))
+            return
+
+        for user in removed:
+            self.sub_socket.setsockopt(zmq.UNSUBSCRIBE, self.user_sub_key(user).encode('ascii'))
+        for user in added:
+            self.sub_socket.setsockopt(zmq.SUBSCRIBE, self.user_sub_key(user).encode('ascii'))
+        self.users = users
+
+        if removed:
+            for topic in [topic for topic in self.pending if self.topic_user(topic) in removed]:
+                del self.pending[topic]
+            self.reset_users |= removed
+
+        print("Changed subscription keys to: {}".format(sorted(self.user_sub_key(user) for user in self.users)))
+        if not self.users:
+            print("No users subscribed; Deep FACS idle")
+
+    # subscription key of a user; e.g. 'p1' --> 'openface.p1.'
+    def user_sub_key(self, user):
+        sub_key_split = list(self.sub_key_split)
+        sub_key_split[self.user_index] = user
+        # user is last key: end with '.' so 'p1' doesn't match 'p10'
+        if self.user_index == len(sub_key_split) - 1:
+            sub_key_split.append("")
+
+        return ".".join(sub_key_split)
+
+    # user of a (dnn) topic; e.g. b'dnn.openface.p1' --> 'p1'
+    def topic_user(self, topic):
+        topic_split = topic.decode('ascii').split(".")
+        # +1: 'dnn.' prefix
+        if self.user_index is not None and len(topic_split) > self.user_index + 1:
+            return topic_split[self.user_index + 1]
 
 
 if __name__ == '__main__':
@@ -215,6 +568,10 @@ if __name__ == '__main__':
                         help="Key for filtering message; Default: '' (all keys)")
     parser.add_argument("--sub_bind", default=False,
                         help="True: socket.bind() / False: socket.connect(); Default: False")
+    parser.add_argument("--users", default=argparse.SUPPRESS,
+                        help="Comma separated users to serve at once, e.g. p0,p1,p2; user in --sub_key is replaced; "
+                             "change with router topic 'dnn': 'p2' (only p2), '+p2' (add), '-p1' (remove); "
+                             "Default: user in --sub_key")
 
     # publisher of DNN generated FACS data
     parser.add_argument("--pub_ip", default=argparse.SUPPRESS,
@@ -226,6 +583,47 @@ if __name__ == '__main__':
     parser.add_argument("--pub_bind", default=False,
                         help="True: socket.bind() / False: socket.connect(); Default: True")
 
+    # model
+    parser.add_argument("--model", default=join("models", "mimicry_trained.h5"),
+                        help="Trained Keras .h5 model; Default: models/mimicry_trained.h5")
+    parser.add_argument("--backend", default="numpy",
+                        help="'numpy': forward pass in numpy, no TensorFlow needed (see numpymodel.py --validate) / "
+                             "'keras': Keras predict; Default: numpy")
+
+    # streaming inference
+    parser.add_argument("--streaming", default=False,
+                        help="True: keep context between frames of a user; recurrent model (numpy backend): carry "
+                             "model state, otherwise: predict on the last --window frames; Default: False")
+    parser.add_argument("--window", default="30",
+                        help="Frames per prediction when streaming without model state; Default: 30")
+    parser.add_argument("--context_max", default="64",
+                        help="Max topics with streaming context; least recently used dropped first; Default: 64")
+    parser.add_argument("--context_idle", default="2",
+                        help="Seconds without frames after which a topic starts without context (next stream); "
+                             "Default: 2")
+
+    # prediction cache
+    parser.add_argument("--cache_resolution", default="0",
+                        help="Reuse output for input AUs equal after rounding to this resolution, e.g. 0.01; "
+                             "stateless models only (no --streaming); Default: 0 (no cache)")
+    parser.add_argument("--cache_size", default="1024",
+                        help="Max cached predictions; least recently used dropped first; Default: 1024")
+    parser.add_argument("--cache_check_every", default="100",
+                        help="Every n-th cache hit is also predicted to report the error of cached output; "
+                             "Default: 100")
+
+    # micro-batching
+    parser.add_argument("--batch_window", default="0",
+                        help="Milliseconds to wait for more frames (other users / next frames) to predict together; "
+                             "higher: more throughput, more latency; Default: 0 (only frames already waiting)")
+    parser.add_argument("--batch_max", default="16",
+                        help="Max frames per predict; Default: 16")
+    parser.add_argument("--queue_max", default="64",
+                        help="Max topics waiting for inference; only the latest frame per topic waits; Default: 64")
+    parser.add_argument("--report_every", default="5",
+                        help="Seconds between printing frames/s, batch size, queue depth and inference time; "
+                             "Default: 5")
+
     # router
     parser.add_argument("--rout_ip", default=argparse.SUPPRESS,
                         help="This PC's IP (e.g. 192.168.x.x) router listens to; Default: 127.0.0.1 (local)")
@@ -241,4 +639,5 @@ if __name__ == '__main__':
     # init FACSvatar message class
     facsvatar_messages = FACSvatarMessages(**vars(args))
     # start processing messages; give list of functions to call async
-    facsvatar_messages.start([facsvatar_messages.deep_sub_pub, facsvatar_messages.set_parameters])
+    facsvatar_messages.start([facsvatar_messages.deep_sub, facsvatar_messages.deep_infer,
+                              facsvatar_messages.set_parameters])
@@ -2,27 +2,219 @@ import os
 from os.path import join
 import sys
 import json
+import time
+import glob
+import hashlib
+import threading
 from collections import defaultdict
+import numpy as np
+
+
+# compiled AU x blendshape matrix; replaced as a whole when mapping files change
+class BlendShapeMapping:
+    def __init__(self, au_names, blendshape_names, au_matrix, blendshape_default, pair_min=None, pair_max=None):
+        # fixed order of AUs and blendshapes
+        self.au_names = list(au_names)
+        self.au_index = {au: i for i, au in enumerate(self.au_names)}
+        self.blendshape_names = list(blendshape_names)
+        self.blendshape_index = {exp: i for i, exp in enumerate(self.blendshape_names)}
+
+        # AU x blendshape; ~20 AUs: a dense product is cheaper than sparse matrix overhead
+        self.au_matrix = au_matrix
+        # default value per blendshape
+        self.blendshape_default = blendshape_default
+
+        # indices of blendshape pairs 'name_min' / 'name_max'; only 1 of a pair can have a value
+        if pair_min is None:
+            pairs = [(self.blendshape_index[exp], self.blendshape_index[exp[:-4] + "_max"])
+                     for exp in self.blendshape_names
+                     if exp.endswith("_min") and exp[:-4] + "_max" in self.blendshape_index]
+            pair_min = np.array([p[0] for p in pairs], dtype=int)
+            pair_max = np.array([p[1] for p in pairs], dtype=int)
+        self.pair_min = pair_min
+        self.pair_max = pair_max
+
+    @classmethod
+    def stack(cls, mappings):
+        """Single mapping that computes several mappings with 1 product
+
+        :param mappings: list of BlendShapeMapping
+        :return: BlendShapeMapping over all AUs; blendshapes of mappings[i] at offsets[i]:offsets[i + 1]
+        """
+
+        au_names = sorted(set().union(*(m.au_names for m in mappings)))
+        au_index = {au: i for i, au in enumerate(au_names)}
+        offsets = np.cumsum([0] + [len(m.blendshape_names) for m in mappings])
+
+        au_matrix = np.zeros((len(au_names), offsets[-1]))
+        for m, offset in zip(mappings, offsets):
+            rows = [au_index[au] for au in m.au_names]
+            au_matrix[rows, offset:offset + len(m.blendshape_names)] = m.au_matrix
+
+        stacked = cls(au_names, [exp for m in mappings for exp in m.blendshape_names], au_matrix,
+                      np.concatenate([m.blendshape_default for m in mappings]),
+                      np.concatenate([m.pair_min + offset for m, offset in zip(mappings, offsets)]),
+                      np.concatenate([m.pair_max + offset for m, offset in zip(mappings, offsets)]))
+        stacked.offsets = offsets
+
+        return stacked
+
+    # store compiled mapping; write to temporary file first, so a cache file is always complete
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        path_tmp = path + ".tmp.npz"
+        np.savez(path_tmp, au_names=np.array(self.au_names), blendshape_names=np.array(self.blendshape_names),
+                 au_matrix=self.au_matrix, blendshape_default=self.blendshape_default)
+        os.replace(path_tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['au_names'].tolist(), data['blendshape_names'].tolist(),
+                       data['au_matrix'], data['blendshape_default'])
 
 
 # change AU values from OpenFace to Blend Shape (Shape Key) values understood by Unity / Blender / Unreal
 # for characters created in Blender + Manual Bastioni addon
 class AUtoBlendShapes:
-    def __init__(self):
-        # dictionary of values for changing AU to blendshapes
-        self.au_dict = self.load_json(join('AU_json'))
-        print(self.au_dict)
+    def __init__(self, au_json_dir='AU_json', blendshape_json='blendshapes_MB.json', cache_dir='mapping_cache',
+                 watch_interval=0):
+        """
+        :param au_json_dir: folder with a .json file per AU
+        :param blendshape_json: .json with all blendshape names and default values
+        :param cache_dir: folder for compiled mappings, keyed by hash of mapping folder and mapping files
+        :param watch_interval: check every x seconds for changed mapping files and reload them; 0 doesn't check
+        """
+
+        self.au_json_dir = au_json_dir
+        self.blendshape_json = blendshape_json
+        self.cache_dir = cache_dir
 
         # frame tracker for index in dataframe
         self.frame_tracker = 0
 
-        # AU to blendshapes
-        self.blendshape_dict_new = json.load(open(join('blendshapes_MB.json'), 'r'))
+        # AUs without json file; only warn once
+        self.au_unknown = set()
+
+        # signature before loading; changes while loading are still noticed by the watcher
+        signature = self.mapping_signature() if watch_interval > 0 else None
+
+        # AU x blendshape matrix; 1 matrix-vector product per frame
+        self.mapping = self.load_mapping()
+
+        # recompile in background when mapping files change
+        if watch_interval > 0:
+            threading.Thread(target=self.watch_mapping, args=(watch_interval, signature), daemon=True).start()
 
         # test
         # for i in range(3):
         #     self.output_blendshapes()
 
+    # paths of all files the mapping is compiled from
+    def mapping_files(self):
+        au_files = sorted(join(self.au_json_dir, f) for f in os.listdir(self.au_json_dir)
+                          if "json" in os.path.splitext(f)[1])
+        return au_files + [self.blendshape_json]
+
+    # hash of names and contents of mapping files
+    def mapping_hash(self):
+        sha = hashlib.sha1()
+        for path in self.mapping_files():
+            sha.update(os.path.basename(path).encode('utf-8'))
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+        return sha.hexdigest()
+
+    # modification time and size of mapping files
+    def mapping_signature(self):
+        return [(f, os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in self.mapping_files()]
+
+    # short hash of where the mapping files are; cache files of the same mapping share this prefix
+    def source_hash(self):
+        source = os.path.abspath(self.au_json_dir) + os.pathsep + os.path.abspath(self.blendshape_json)
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]
+
+    # compiled mapping from cache, or compile and cache it
+    def load_mapping(self):
+        source_hash = self.source_hash()
+        cache_file = join(self.cache_dir, source_hash + "_" + self.mapping_hash() + ".npz")
+
+        if os.path.exists(cache_file):
+            print("Loading compiled mapping: {}".format(cache_file))
+            return BlendShapeMapping.load(cache_file)
+
+        mapping = self.compile_mapping()
+        mapping.save(cache_file)
+        print("Saved compiled mapping: {}".format(cache_file))
+
+        # older compiled versions of the same mapping files are never loaded again
+        for f in glob.glob(join(self.cache_dir, source_hash + "_*.npz")):
+            if f != cache_file and not f.endswith(".tmp.npz"):
+                try:
+                    os.remove(f)
+                    print("Removed old compiled mapping: {}".format(f))
+                except OSError as e:
+                    print("Old compiled mapping not removed: {}".format(e))
+
+        return mapping
+
+    # compile AU json dicts into a matrix over a fixed blendshape index
+    def compile_mapping(self):
+        # dictionary of values for changing AU to blendshapes
+        au_dict = self.load_json(self.au_json_dir)
+        print(au_dict)
+
+        # AU to blendshapes
+        blendshape_dict = json.load(open(self.blendshape_json, 'r'))
+
+        au_names = sorted(au_dict)
+        au_index = {au: i for i, au in enumerate(au_names)}
+        blendshape_names = list(blendshape_dict)
+
+        # sparse (AU, blendshape, value) entries; blendshapes missing in blendshape json are added at the end
+        entries = []
+        for au, blend_dict in au_dict.items():
+            for exp, exp_v in blend_dict.items():
+                if exp not in blendshape_dict:
+                    print("Blendshape {} of {} not in blendshape json; adding it".format(exp, au))
+                    blendshape_dict[exp] = 0.0
+                    blendshape_names.append(exp)
+                entries.append((au_index[au], exp, exp_v))
+        blendshape_index = {exp: i for i, exp in enumerate(blendshape_names)}
+
+        au_matrix = np.zeros((len(au_names), len(blendshape_names)))
+        for au_i, exp, exp_v in entries:
+            au_matrix[au_i, blendshape_index[exp]] += exp_v
+
+        blendshape_default = np.fromiter(blendshape_dict.values(), dtype=float, count=len(blendshape_names))
+
+        print("Compiled {} AUs x {} blendshapes ({} non-zero)".format(len(au_names), len(blendshape_names),
+                                                                      np.count_nonzero(au_matrix)))
+        return BlendShapeMapping(au_names, blendshape_names, au_matrix, blendshape_default)
+
+    # recompile when mapping files change; runs in background thread
+    def watch_mapping(self, interval, signature=None):
+        print("Watching mapping files every {} seconds".format(interval))
+
+        while True:
+            try:
+                signature_old = signature
+                # taken before loading; a change during loading triggers another reload
+                signature = self.mapping_signature()
+
+                if signature_old is not None and signature != signature_old:
+                    print("Mapping files changed; recompiling")
+                    time_start = time.time()
+                    # swap as a whole; frames use either the old or the new mapping
+                    self.mapping = self.load_mapping()
+                    print("Mapping swapped in {:.3f} s".format(time.time() - time_start))
+
+            # e.g. file saved halfway; keep old mapping until files change again
+            except (Exception, SystemExit) as e:
+                print("Mapping not reloaded: {}".format(e))
+
+            time.sleep(interval)
+
     # open all AU .json file in directory
     def load_json(self, json_dir):
         au_dict = {}
@@ -45,14 +237,20 @@ class AUtoBlendShapes:
         #if "structural" in json_file:
         return json_file["structural"]
 
-    # json dict of blendshape names
-    def load_blendshape_dict(self):
-        # load json as dict
-        # if not self.blendshape_dict:
-        #     self.blendshape_dict_new = json.load(open(join('blendshapes.json'), 'r'))
+    # AU dict to vector in order of mapping.au_names
+    def au_vector(self, mapping, facs_dict):
+        for au in facs_dict:
+            # only AU values
+            if au not in mapping.au_index and au.startswith('AU') and au not in self.au_unknown:
+                print("No json file found for {}".format(au))
+                self.au_unknown.add(au)
+
+        au_v = np.fromiter((facs_dict.get(au, 0.0) for au in mapping.au_names), dtype=float,
+                           count=len(mapping.au_names))
+        # don't let (tracking) noise change blendshapes
+        au_v[au_v <= 0.001] = 0.0
 
-        # reset dict to default 0; make thread safe (untested) deep copy
-        self.blendshape_dict = json.loads(json.dumps(self.blendshape_dict_new))
+        return au_v
 
     # add "_min" or "_max" to blendshape + value conversion (because it uses 0.5 as cutoff for min/max)
     # based on Manuel Bastioni v1.6.0
@@ -87,46 +285,54 @@ class AUtoBlendShapes:
 
     # receive AU values and change to blendshapes
     def calc_blendshapes(self, facs_dict):
-        # get a clean blendshape dict
-        self.load_blendshape_dict()
-
-        # loop over AU values from OpenFace data frame
-        for au, au_v in facs_dict.items():
-            # only loop over AU values
-            if au.startswith('AU'):
-                # check if we have AU convert file
-                if au in self.au_dict:
-                    # don't waste computing power when nothing changes
-                    # TODO make if statement about difference previous AU
-                    if au_v > 0.001:
-                        # remove '_r'
-                        #au = au[:-2]
-                        #print(au, au_v)
-
-                        # loop over all blendshapes related to that AU
-                        #print(self.au_dict[au])
-                        # TODO error: KeyError: 'AU'
-                        for exp, exp_v in self.au_dict[au].items():
-                            #print(exp, exp_v)
-                            # multiply AU value with au_dict to get blendshape values and
-                            # add blendshape values to total blendshape_dict
-                            self.blendshape_dict[exp] += round(exp_v * au_v, 5)
-                            #print(self.blendshape_dict[exp])
-
-                else:
-                    print("No json file found for {}".format(au))
-
-        # TODO resolve _min _max (only 1 can have value, so subtract from each other)
-
-        # TODO limit blendshape value to max 1
-        #min(current_val + sk_value, 1.0)
-
-        # TODO? return None for non-changed values
+        # same mapping for whole frame, even when swapped meanwhile
+        mapping = self.mapping
+        self.blendshape_names = mapping.blendshape_names
+        self.blendshape_values = self.calc_mapping(mapping, facs_dict)
+
+        # only changed values: see DeltaEncoder in pub_blend.py
+
+        return self.blendshape_values
+
+    # blendshape vector of a (stacked) mapping
+    def calc_mapping(self, mapping, facs_dict):
+        return self.au_to_blend(mapping, self.au_vector(mapping, facs_dict))
+
+    # blendshape matrix (frame x blendshape) of several frames with 1 matrix multiplication
+    def calc_mapping_batch(self, mapping, facs_dicts):
+        au_m = np.empty((len(facs_dicts), len(mapping.au_names)))
+        for i, facs_dict in enumerate(facs_dicts):
+            au_m[i] = self.au_vector(mapping, facs_dict)
+
+        return self.au_to_blend(mapping, au_m)
+
+    # AU vector (or frame x AU matrix) to blendshape vector (or frame x blendshape matrix)
+    def au_to_blend(self, mapping, au_v):
+        # multiply AU values with AU matrix and add to default blendshape values
+        blend_v = mapping.blendshape_default + au_v @ mapping.au_matrix
+
+        # resolve _min _max (only 1 can have value, so subtract from each other)
+        net = blend_v[..., mapping.pair_max] - blend_v[..., mapping.pair_min]
+        blend_v[..., mapping.pair_max] = np.maximum(net, 0.0)
+        blend_v[..., mapping.pair_min] = np.maximum(-net, 0.0)
+
+        # limit blendshape value to 0-1; make values less ugly
+        return np.round(np.clip(blend_v, 0.0, 1.0), 5)
+
+    # blendshape vector to {blendshape name: value}
+    def blendshape_to_dict(self, blend_v):
+        return dict(zip(self.blendshape_names, blend_v.tolist()))
+
+    # iterate over AU data extracted by OpenFace; returns numpy array in order of self.blendshape_names
+    # (blendshape names of the mapping used for this frame)
+    def output_blendshapes_array(self, facs_dict):
+        self.calc_blendshapes(facs_dict)
+        self.frame_tracker += 1
+
+        return self.blendshape_values
 
     # iterate over AU data extracted by OpenFace
     def output_blendshapes(self, facs_dict):
         print("Frame: {}".format(self.frame_tracker))
-        self.calc_blendshapes(facs_dict)  # next(self.df_au.itertuples())
-        self.frame_tracker += 1
 
-        return self.blendshape_dict  # self.blend_val
\ No newline at end of file
+        return self.blendshape_to_dict(self.output_blendshapes_array(facs_dict))
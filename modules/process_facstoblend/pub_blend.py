@@ -6,24 +6,106 @@ import os
 import sys
 import argparse
 import json
+import logging
+import traceback
+import zmq.asyncio
 
 
 # own imports; if statement for documentation
 if __name__ == '__main__':
     sys.path.append("..")
     from facsvatarzeromq import FACSvatarZeroMQ
-    from au2blendshapes_mb import AUtoBlendShapes  # when using Manuel Bastioni models
+    from au2blendshapes_mb import AUtoBlendShapes, BlendShapeMapping  # when using Manuel Bastioni models
     #from au2blendshapes_mh import AUtoBlendShapes  # when using FACSHuman models
+    from bundlemsg import is_bundle, unbundle, BUNDLE_KEY
 else:
     from modules.facsvatarzeromq import FACSvatarZeroMQ
-    from .au2blendshapes_mb import AUtoBlendShapes  # when using Manuel Bastioni models
+    from modules.bundlemsg import is_bundle, unbundle, BUNDLE_KEY
+    from .au2blendshapes_mb import AUtoBlendShapes, BlendShapeMapping  # when using Manuel Bastioni models
     # from .au2blendshapes_mh import AUtoBlendShapes  # when using FACSHuman models
 
 
+# several avatar rigs (AU --> blendshape mappings) computed together
+class RigRegistry:
+    def __init__(self, rigs=None, watch_interval=0):
+        """
+        :param rigs: dict of rig name: (AU json folder, blendshape json); None: Manuel Bastioni only
+        :param watch_interval: seconds between checks for changed mapping files; 0 doesn't reload
+        """
+
+        if not rigs:
+            rigs = {'mb': ('AU_json', 'blendshapes_MB.json')}
+
+        # rig name: AUtoBlendShapes
+        self.rigs = {name: AUtoBlendShapes(au_json_dir, blendshape_json, watch_interval=watch_interval)
+                     for name, (au_json_dir, blendshape_json) in rigs.items()}
+        self.rig_names = list(self.rigs)
+
+        # stacked mapping of last used rigs; rebuild when rigs or their mappings change
+        # mapping objects themselves kept (not id()); id of a reloaded mapping can be reused
+        self.stack_rigs = None
+        self.stack_mappings = []
+        self.stacked = None
+
+    # rigs from command line string: name=au_json_folder:blendshape_json,name2=...
+    @staticmethod
+    def parse_rigs(rigs_arg):
+        rigs = {}
+        for rig in filter(None, rigs_arg.split(",")):
+            name, paths = rig.split("=")
+            au_json_dir, blendshape_json = paths.split(":")
+            rigs[name] = (au_json_dir, blendshape_json)
+
+        return rigs
+
+    def calc_blendshapes(self, au_dict, rig_names):
+        """Blendshape dict per rig with 1 matrix product for all rigs
+
+        :param au_dict: received AU values
+        :param rig_names: rigs to compute, e.g. only rigs with subscribers
+        :return: dict of rig name: blendshape dict
+        """
+
+        return self.calc_blendshapes_batch([au_dict], rig_names)[0]
+
+    def calc_blendshapes_batch(self, au_dicts, rig_names):
+        """Blendshape dict per rig of several frames with 1 matrix product for all frames and rigs
+
+        :param au_dicts: list of received AU values
+        :param rig_names: rigs to compute
+        :return: list (same order as au_dicts) of dict of rig name: blendshape dict
+        """
+
+        mappings = [self.rigs[rig].mapping for rig in rig_names]
+        if tuple(rig_names) != self.stack_rigs or len(mappings) != len(self.stack_mappings) or \
+                any(m is not m_stack for m, m_stack in zip(mappings, self.stack_mappings)):
+            self.stacked = BlendShapeMapping.stack(mappings)
+            self.stack_rigs = tuple(rig_names)
+            self.stack_mappings = mappings
+
+        blend_m = self.rigs[rig_names[0]].calc_mapping_batch(self.stacked, au_dicts).tolist()
+        offsets = self.stacked.offsets
+
+        return [{rig: dict(zip(m.blendshape_names, blend_v[offsets[i]:offsets[i + 1]]))
+                 for i, (rig, m) in enumerate(zip(rig_names, mappings))}
+                for blend_v in blend_m]
+
+
 # process everything that is received
 class BlendShapeMsg:
-    def __init__(self):
-        self.au_to_blendshapes = AUtoBlendShapes()
+    def __init__(self, watch_interval=0, rigs=None):
+        # watch_interval: seconds between checks for changed mapping files; 0 doesn't reload
+        # rigs: see RigRegistry
+        self.rig_registry = RigRegistry(rigs, watch_interval)
+        self.au_to_blendshapes = self.rig_registry.rigs[self.rig_registry.rig_names[0]]
+
+    # blendshapes of several rigs; dict of rig name: blendshape dict
+    async def facs_to_blendshape_rigs(self, au_dict, rig_names):
+        return self.rig_registry.calc_blendshapes(au_dict, rig_names)
+
+    # blendshapes of several frames and rigs; list of dict of rig name: blendshape dict
+    async def facs_to_blendshape_batch(self, au_dicts, rig_names):
+        return self.rig_registry.calc_blendshapes_batch(au_dicts, rig_names)
 
     async def facs_to_blendshape(self, au_dict):  # , id_cb, type_cb
         # au_dict: received facs values in JSON format
@@ -63,44 +145,254 @@ class BlendShapeMsg:
     #     return msg_dict
 
 
+# only send blendshapes that changed since last frame; full keyframe every x frames or on request
+class DeltaEncoder:
+    def __init__(self, epsilon=0.0, keyframe_every=30):
+        """
+        :param epsilon: blendshape is sent when it differs more than this from the last sent value; 0: always full frames
+        :param keyframe_every: send all blendshapes every x frames
+        """
+
+        self.epsilon = epsilon
+        self.keyframe_every = keyframe_every
+
+        # topic: {'seq', 'names', 'last', 'since_keyframe'}
+        self.topic_state = {}
+
+    # next message of topics starting with prefix is a keyframe; reset: also restart sequence numbers (new stream)
+    def request_keyframe(self, topic_prefix="", reset=False):
+        for topic in [tp for tp in self.topic_state if tp.startswith(topic_prefix)]:
+            if reset:
+                del self.topic_state[topic]
+            else:
+                self.topic_state[topic]['since_keyframe'] = self.keyframe_every
+
+    def encode(self, topic, data):
+        """Replace data['blendshapes'] by changed blendshapes; adds 'seq' and 'keyframe'
+
+        Receivers missing a sequence number should apply the next keyframe (or request one) to resync.
+        """
+
+        # disabled or nothing to encode (empty data)
+        if not self.epsilon or not data or 'blendshapes' not in data:
+            return data
+
+        blend_dict = data['blendshapes']
+        state = self.topic_state.get(topic)
+        seq = state['seq'] + 1 if state else 0
+
+        # keyframe: first frame, every x frames or when mapping has other blendshapes (reloaded)
+        if not state or state['since_keyframe'] + 1 >= self.keyframe_every or state['names'] != blend_dict.keys():
+            self.topic_state[topic] = {'seq': seq, 'names': blend_dict.keys(), 'last': dict(blend_dict),
+                                       'since_keyframe': 0}
+            data['keyframe'] = True
+
+        else:
+            # compare with last sent value, so receiver stays within epsilon
+            last = state['last']
+            blend_delta = {bs: val for bs, val in blend_dict.items() if abs(val - last[bs]) > self.epsilon}
+            last.update(blend_delta)
+            state['seq'] = seq
+            state['since_keyframe'] += 1
+
+            data['blendshapes'] = blend_delta
+            data['keyframe'] = False
+
+        data['seq'] = seq
+
+        return data
+
+
 # client to message broker server
 class FACSvatarMessages(FACSvatarZeroMQ):
     """Receives FACS and Head movement data; FACS --> Blend Shapes; Publish new data"""
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.blendshape = BlendShapeMsg()
+        rigs = RigRegistry.parse_rigs(self.misc.get('rigs', ""))
+        self.blendshape = BlendShapeMsg(float(self.misc.get('watch_mapping', 0)), rigs)
+        self.rig_names = self.blendshape.rig_registry.rig_names
+        # multiple rigs: rig name as topic suffix; single rig: topic unchanged
+        self.rig_suffix = len(self.rig_names) > 1
+        # publish bundled messages per participant topic
+        self.unbundle = self.misc.get('unbundle', True) in (True, "True", "true", "1")
 
-    async def blenshape_sub_pub(self):
-        # keep listening to all published message on topic 'facs'
+        # subscribed topic prefixes; None: no XPUB socket, assume every rig has subscribers
+        self.subscriptions = set() if kwargs.get('pub_xpub') else None
+
+        # max number of waiting messages converted together; 1: every message on its own
+        self.batch_max = int(self.misc.get('batch_max', 1))
+
+        # only publish changed blendshapes
+        self.delta_encoder = DeltaEncoder(float(self.misc.get('delta_epsilon', 0)),
+                                          int(self.misc.get('keyframe_every', 30)))
+
+    # topic of a rig
+    def rig_topic(self, topic, rig):
+        return topic + "." + rig if self.rig_suffix else topic
+
+    # rigs with a subscriber for this topic
+    def active_rigs(self, topic):
+        if self.subscriptions is None:
+            return self.rig_names
+
+        return [rig for rig in self.rig_names
+                if any(self.rig_topic(topic, rig).startswith(sub) for sub in self.subscriptions)]
+
+    # keep track of subscriptions (XPUB); first byte 1: subscribe, 0: unsubscribe; followed by topic prefix
+    async def track_subscribers(self):
         while True:
-            msg = await self.sub_socket.recv_multipart()
+            msg = await self.pub_socket.recv()
+            prefix = msg[1:].decode('ascii')
+            if msg[0] == 1:
+                self.subscriptions.add(prefix)
+            else:
+                self.subscriptions.discard(prefix)
+            print("Subscriptions: {}".format(self.subscriptions))
+
+    # AU data --> blendshape data of a single participant; dict of rig name: data (skipped rigs not included)
+    async def data_to_blendshape(self, topic, data):
+        return (await self.data_to_blendshape_batch([(topic, data)]))[0]
+
+    # list of (topic, data) --> list of dict of rig name: data; all frames with the same active rigs in 1 pass
+    async def data_to_blendshape_batch(self, topic_data):
+        rig_data = [None] * len(topic_data)
+
+        # frame index per set of active rigs
+        rig_groups = {}
+        for i, (topic, data) in enumerate(topic_data):
+            rig_names = self.active_rigs(topic)
+            # check not empty
+            if not data or not rig_names:
+                rig_data[i] = {rig: data for rig in rig_names}
+            else:
+                rig_groups.setdefault(tuple(rig_names), []).append(i)
+
+        for rig_names, frame_ids in rig_groups.items():
+            # transform Action Units to Blend Shapes; all frames and rigs at once
+            blend_list = await self.blendshape.facs_to_blendshape_batch(
+                [topic_data[i][1].pop('au_r') for i in frame_ids], list(rig_names))
+
+            # add blendshapes to copy of data (without au_r) per rig
+            for i, blend_rigs in zip(frame_ids, blend_list):
+                data = topic_data[i][1]
+                rig_data[i] = {rig: {**data, 'blendshapes': blend_dict} for rig, blend_dict in blend_rigs.items()}
+
+        return rig_data
+
+    # received message --> (topic, bundle key, data) per participant to convert
+    def msg_sections(self, topic, data):
+        # all participants of 1 frame
+        if is_bundle(data):
+            # consumers want a topic per participant
+            if self.unbundle:
+                sections = []
+                for section_topic, section in unbundle(topic, data):
+                    # copy user_ignore set by mixer to every participant
+                    if section and 'user_ignore' in data:
+                        section['user_ignore'] = data['user_ignore']
+                    sections.append((section_topic, None, section))
+
+                return sections
+
+            # forward bundle; keep bundle key
+            return [(topic, key, section) for key, section in data[BUNDLE_KEY].items()]
+
+        return [(topic, None, data)]
+
+    async def pub_msg(self, topic, timestamp, data):
+        # async always needs `send_multipart()`
+        await self.pub_socket.send_multipart([topic.encode('ascii'),  # topic
+                                              timestamp,
+                                              # data in JSON format or empty byte
+                                              json.dumps(data).encode('utf-8')
+                                              ])
+
+    # convert all received messages in 1 pass; publish in order of arrival
+    async def blendshape_msgs(self, msgs):
+        # (msg, topic, sections) per message
+        msg_sections = []
+        for msg in msgs:
             print("message: {}".format(msg))
 
             # check not finished; timestamp is empty (b'')
             if msg[1]:
                 # process message
-                msg[2] = json.loads(msg[2].decode('utf-8'))
-                # check not empty
-                if msg[2]:
-                    # transform Action Units to Blend Shapes
-                    msg[2]['blendshapes'] = await self.blendshape.facs_to_blendshape(msg[2]['au_r'])
-                    # remove au_r from dict
-                    msg[2].pop('au_r')
-
-                print(msg)
-                # async always needs `send_multipart()`
-                await self.pub_socket.send_multipart([msg[0],  # topic
-                                          msg[1],  # timestamp
-                                          # data in JSON format or empty byte
-                                          json.dumps(msg[2]).encode('utf-8')
-                                          ])
+                data = json.loads(msg[2].decode('utf-8'))
+                topic = msg[0].decode('ascii')
+                msg_sections.append((msg, topic, data, self.msg_sections(topic, data)))
+            else:
+                msg_sections.append((msg, None, None, []))
 
+        # convert every participant of every message
+        rig_data = iter(await self.data_to_blendshape_batch(
+            [(topic, section) for _, _, _, sections in msg_sections for topic, _, section in sections]))
+
+        for msg, topic, data, sections in msg_sections:
             # send message we're done
-            else:
+            if not msg[1]:
                 print("No more messages to publish; Blend Shapes done")
+                # next stream on this topic starts with a keyframe
+                self.delta_encoder.request_keyframe(msg[0].decode('ascii'), reset=True)
                 await self.pub_socket.send_multipart([msg[0], b'', b''])
 
+            # forward bundle per rig
+            elif is_bundle(data) and not self.unbundle:
+                rig_bundles = {rig: {**data, BUNDLE_KEY: {}} for rig in self.active_rigs(topic)}
+                for _, key, _ in sections:
+                    for rig, rig_section in next(rig_data).items():
+                        # participant in bundle has its own delta state
+                        rig_bundles[rig][BUNDLE_KEY][key] = \
+                            self.delta_encoder.encode(self.rig_topic(topic, rig) + "." + key, rig_section)
+
+                for rig, bundle in rig_bundles.items():
+                    await self.pub_msg(self.rig_topic(topic, rig), msg[1], bundle)
+
+            # message per participant
+            else:
+                for section_topic, _, _ in sections:
+                    for rig, rig_section in next(rig_data).items():
+                        rig_topic = self.rig_topic(section_topic, rig)
+                        rig_section = self.delta_encoder.encode(rig_topic, rig_section)
+                        print(rig_section)
+                        await self.pub_msg(rig_topic, msg[1], rig_section)
+
+    async def blenshape_sub_pub(self):
+        # keep listening to all published message on topic 'facs'
+        while True:
+            msgs = [await self.sub_socket.recv_multipart()]
+
+            # messages waiting (burst / several streams) are converted together
+            while len(msgs) < self.batch_max:
+                try:
+                    msgs.append(await self.sub_socket.recv_multipart(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+
+            await self.blendshape_msgs(msgs)
+
+    # receive commands
+    async def set_parameters(self):
+        print("Router awaiting commands")
+
+        while True:
+            try:
+                [id_dealer, topic, data] = await self.rout_socket.recv_multipart()
+                print("Command received from '{}', with topic '{}' and msg '{}'".format(id_dealer, topic, data))
+
+                tp = topic.decode('ascii')
+                # send full blendshapes for topics starting with data (all topics when empty)
+                if tp.startswith("keyframe"):
+                    self.delta_encoder.request_keyframe(data.decode('utf-8'))
+                else:
+                    print("Command ignored")
+
+            except Exception as e:
+                print("Error with router function")
+                # print(e)
+                logging.error(traceback.format_exc())
+                print()
+
 
 if __name__ == '__main__':
     # command line arguments
@@ -125,12 +417,44 @@ if __name__ == '__main__':
                         help="Key for filtering message; Default: blendshapes.human")
     parser.add_argument("--pub_bind", default=True,
                         help="True: socket.bind() / False: socket.connect(); Default: True")
+    parser.add_argument("--pub_xpub", default=False,
+                        help="True: XPUB socket; rigs without subscriber for a topic are skipped; Default: False")
+    parser.add_argument("--rigs", default="",
+                        help="Several avatar rigs as name=AU_json_folder:blendshape_json,name2=..; blendshapes are "
+                             "published on topic.name per rig; Default: '' (Manuel Bastioni, topic unchanged)")
+    parser.add_argument("--watch_mapping", default="0",
+                        help="Reload AU_json / blendshape json every x seconds when changed, without restart; "
+                             "Default 0 (no reload)")
+    parser.add_argument("--unbundle", default=True,
+                        help="True: publish bundled messages as 1 message per participant topic; Default: True")
+    parser.add_argument("--batch_max", default="1",
+                        help="Max number of waiting messages converted with 1 matrix product; see "
+                             "benchmark/bench_blend_batch.py; Default: 1 (every message on its own)")
+    parser.add_argument("--delta_epsilon", default="0",
+                        help="Only publish blendshapes changed more than this since last frame; "
+                             "Default: 0 (full frames)")
+    parser.add_argument("--keyframe_every", default="30",
+                        help="With --delta_epsilon, publish all blendshapes every x frames; Default: 30")
+
+    # router
+    parser.add_argument("--rout_ip", default=argparse.SUPPRESS,
+                        help="This PC's IP (e.g. 192.168.x.x) router listens to; Default: 127.0.0.1 (local)")
+    parser.add_argument("--rout_port", default="5583",
+                        help="Port dealers message to (e.g. topic 'keyframe'); Default: 5583")
+    parser.add_argument("--rout_bind", default=True,
+                        help="True: socket.bind() / False: socket.connect(); Default: True")
 
     args, leftovers = parser.parse_known_args()
     print("The following arguments are used: {}".format(args))
     print("The following arguments are ignored: {}\n".format(leftovers))
 
+    # string from command line to bool
+    args.pub_xpub = args.pub_xpub in (True, "True", "true", "1")
+
     # init FACSvatar message class
     facsvatar_messages = FACSvatarMessages(**vars(args))
     # start processing messages; give list of functions to call async
-    facsvatar_messages.start([facsvatar_messages.blenshape_sub_pub])
+    async_list = [facsvatar_messages.blenshape_sub_pub, facsvatar_messages.set_parameters]
+    if facsvatar_messages.subscriptions is not None:
+        async_list.append(facsvatar_messages.track_subscribers)
+    facsvatar_messages.start(async_list)
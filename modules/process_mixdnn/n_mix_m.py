@@ -24,23 +24,81 @@ TODO: register somewhere for a bus overview"""
 # License: GNU Lesser General Public License
 
 
+import os
 import sys
 import argparse
+import time
 from functools import partial
+from bisect import bisect_left
+from collections import deque
 import zmq.asyncio
 import traceback
 import logging
 import numpy as np
 import json
-import queue
 # import asyncio
 
 # own import; if statement for documentation
 if __name__ == '__main__':
     sys.path.append("..")
     from facsvatarzeromq import FACSvatarZeroMQ
+    from bundlemsg import is_bundle, section_topic, BUNDLE_KEY
 else:
     from modules.facsvatarzeromq import FACSvatarZeroMQ
+    from modules.bundlemsg import is_bundle, section_topic, BUNDLE_KEY
+
+
+# last frames of a user with their timestamp; memory bounded by size
+class TimeBuffer:
+    def __init__(self, size):
+        self.timestamps = deque(maxlen=size)
+        self.frames = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, timestamp, frame):
+        # timestamp went back (e.g. restarted source): older frames don't belong to this stream
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            self.timestamps.clear()
+            self.frames.clear()
+
+        self.timestamps.append(timestamp)
+        self.frames.append(frame)
+
+    # (frame, |timestamp difference|) of frame nearest to timestamp; None when empty
+    def nearest(self, timestamp):
+        if not self.frames:
+            return None
+
+        i = bisect_left(self.timestamps, timestamp)
+        # closest of neighbours
+        if i == len(self.timestamps) or \
+                (i > 0 and timestamp - self.timestamps[i - 1] <= self.timestamps[i] - timestamp):
+            i -= 1
+
+        return self.frames[i], abs(self.timestamps[i] - timestamp)
+
+
+# fixed channel order of mixed data: (data section, key)
+CHANNELS = [('au_r', key) for key in ('AU01', 'AU02', 'AU04', 'AU05', 'AU06', 'AU07', 'AU09', 'AU10', 'AU12', 'AU14',
+                                      'AU15', 'AU17', 'AU20', 'AU23', 'AU25', 'AU26', 'AU45',
+                                      'AU61', 'AU62', 'AU63', 'AU64')] + \
+           [('pose', key) for key in ('pose_Rx', 'pose_Ry', 'pose_Rz')] + \
+           [('gaze', key) for key in ('gaze_angle_x', 'gaze_angle_y')]
+CHANNEL_INDEX = {key: i for i, (_, key) in enumerate(CHANNELS)}
+# names for several channels in mixing rules
+CHANNEL_GROUPS = {'au': [i for i, (section, _) in enumerate(CHANNELS) if section == 'au_r'],
+                  'pose': [i for i, (section, _) in enumerate(CHANNELS) if section == 'pose'],
+                  'gaze': [i for i, (section, _) in enumerate(CHANNELS) if section == 'gaze']}
+# DNN output gets eye blink, eye gaze AUs and head pose of the user whose avatar shows it
+MIX_DEFAULT = ('AU45', 'AU61', 'AU62', 'AU63', 'AU64', 'pose')
+
+
+# data dict --> values in CHANNELS order; NaN: not in data
+def data_to_array(data):
+    return np.array([data[section].get(key, np.nan) if isinstance(data.get(section), dict) else np.nan
+                     for section, key in CHANNELS], dtype=float)
 
 
 class FACSvatarMessages(FACSvatarZeroMQ):
@@ -52,17 +110,153 @@ class FACSvatarMessages(FACSvatarZeroMQ):
         # keep dict of smooth object per topic
         self.smooth_obj_dict = {}
 
-        # user which is not analysed by DNN; storing head pose / eye blink
-        self.dnn_user_store = "p1"
+        # participant key (e.g. 'p0'): index
+        self.participants = {}
+        for user in self.misc.get('participants', "p0,p1").split(","):
+            self.participant(user.strip())
+        # topic: (DNN topic, participant index or None); topics are checked once
+        self.topic_index = {}
+
+        # frames per stored participant; DNN frames are merged with the stored frame nearest in time
+        self.buffer_size = int(self.misc.get('buffer_size', 120))
+        self.buffers = {}
+
+        # set by set_rules(): DNN participant: [(source participant, channel mask)] / avatar showing DNN output
+        self.mix = {}
+        self.targets = {}
+        self.user_ignore = ""
+        if self.misc.get('mix_rules'):
+            mix_rules = self.misc['mix_rules']
+            # file or JSON string
+            if os.path.isfile(mix_rules):
+                with open(mix_rules) as f:
+                    mix_rules = f.read()
+            self.set_rules(json.loads(mix_rules))
+        # 2 participants: DNN of p0, shown on avatar of p1
+        else:
+            self.set_rules(self.default_rules("p1"))
+
+        # |DNN timestamp - stored timestamp| (ms) per merge / DNN frames without stored frame since last report
+        self.match_errors = []
+        self.unmatched = 0
+        self.report_every = float(self.misc.get('report_every', 5))
+        self.time_report = time.time()
+
+    # index of participant; new participants get the next index
+    def participant(self, user):
+        if user not in self.participants:
+            self.participants[user] = len(self.participants)
+            # topics of new participant might be known
+            self.topic_index = {}
+
+        return self.participants[user]
+
+    # (DNN topic, participant index or None); e.g. 'dnn.openface.p0' --> (True, 0)
+    def topic_participant(self, topic):
+        if topic not in self.topic_index:
+            topic_split = topic.split(".")
+            users = [self.participants[key] for key in topic_split if key in self.participants]
+            self.topic_index[topic] = (topic_split[0] == "dnn", users[0] if users else None)
+
+        return self.topic_index[topic]
+
+    # rules of 2 participants; DNN of 1 shown on avatar of other (user_store) with user_store's blink / gaze / pose
+    def default_rules(self, user_store):
+        return {user: {'target': user_store, **{channel: user_store for channel in MIX_DEFAULT}}
+                for user in self.participants if user != user_store}
+
+    # {DNN participant: {'target': avatar showing DNN output, channel / channel group: participant or 'dnn'}}
+    def set_rules(self, rules):
+        mix = {}
+        targets = {}
+        for dnn_user, channel_sources in rules.items():
+            masks = {}
+            # channel groups first; single channels override
+            for channel, source in sorted(channel_sources.items(), key=lambda item: item[0] not in CHANNEL_GROUPS):
+                if channel == 'target':
+                    targets[self.participant(dnn_user)] = source
+                    continue
+                if channel not in CHANNEL_GROUPS and channel not in CHANNEL_INDEX:
+                    raise ValueError("Unknown channel in mixing rules: {}".format(channel))
+
+                indices = CHANNEL_GROUPS.get(channel, [CHANNEL_INDEX.get(channel)])
+                for mask in masks.values():
+                    mask[indices] = False
+                # 'dnn': keep DNN output
+                if source != "dnn":
+                    masks.setdefault(self.participant(source), np.zeros(len(CHANNELS), dtype=bool))[indices] = True
+
+            mix[self.participant(dnn_user)] = [(source, mask) for source, mask in masks.items() if mask.any()]
+
+        self.mix = mix
+        self.targets = targets
+        # avatars not showing own data; DNN messages get only the target of their stream
+        self.user_ignore = ",".join(sorted(set(targets.values())))
+
+        # only keep frames of participants used for mixing; keep frames of participants still used
+        self.buffers = {source: self.buffers.get(source, TimeBuffer(self.buffer_size))
+                        for sources in mix.values() for source, _ in sources}
+        print("Mixing rules: {}".format(rules))
+
+    # merge data of a single participant; returns None when data shouldn't be forwarded
+    # timestamp: msg[1] in ms
+    def mix_msg(self, topic, timestamp, data):
+        # only pass on messages with enough tracking confidence; always send when no confidence param
+        if 'confidence' in data and data['confidence'] < 0.7:
+            print("Not enough tracking confidence to forward message")
+            return None
+
+        dnn, user = self.topic_participant(topic)
+
+        # store data from participants used for mixing
+        if not dnn:
+            if user in self.buffers:
+                self.buffers[user].add(timestamp, data_to_array(data))
+
+        # use stored data of other participants, e.g. eye blink, eye gaze and head pose
+        elif user in self.mix:
+            print("DNN uses stored data")
+            for source, mask in self.mix[user]:
+                stored = self.buffers[source].nearest(timestamp)
+                if stored is None:
+                    self.unmatched += 1
+                    continue
+
+                stored_values, match_error = stored
+                self.match_errors.append(match_error)
+
+                # channels of this source, when source has them
+                for i in np.flatnonzero(mask & ~np.isnan(stored_values)):
+                    section, key = CHANNELS[i]
+                    if not isinstance(data.get(section), dict):
+                        data[section] = {}
+                    data[section][key] = stored_values[i].item()
+
+            self.track_matches()
+
+        # add target user to display data (and not display original data)
+        data['user_ignore'] = self.targets.get(user, self.user_ignore) if dnn else self.user_ignore
+
+        return data
+
+    # print buffer occupancy and match error every report_every seconds
+    def track_matches(self):
+        time_now = time.time()
+        if time_now - self.time_report >= self.report_every:
+            users = {i: user for user, i in self.participants.items()}
+            print("Mix: buffer {} frames, match error {}, {} DNN frames without stored data".format(
+                ", ".join("{} {}/{}".format(users[i], len(buffer), self.buffer_size)
+                          for i, buffer in self.buffers.items()),
+                "{:.1f} ms mean / {:.0f} ms max".format(np.mean(self.match_errors), np.max(self.match_errors))
+                if self.match_errors else "-", self.unmatched))
+            self.match_errors = []
+            self.unmatched = 0
+            self.time_report = time_now
 
     # TODO work with single user
     async def pub_sub_function(self, apply_function):  # async
         """Subscribes to FACS data, smooths, publishes it"""
 
-        # store data of non-DNN user
-        user_data_au = queue.Queue()
-        user_data_pose = queue.Queue()
-
         # await messages
         print("Awaiting FACS data...")
         # without try statement, no error output
@@ -76,79 +270,29 @@ class FACSvatarMessages(FACSvatarZeroMQ):
                 # check not finished; timestamp is empty (b'')
                 if msg[1]:
                     msg[2] = json.loads(msg[2].decode('utf-8'))
-
-                    # only pass on messages with enough tracking confidence; always send when no confidence param
-                    if 'confidence' not in msg[2] or msg[2]['confidence'] >= 0.7:
-                        # subscription key / topic
-                        topic = msg[0].decode('ascii')
-
-                        # check au dict in data and not empty
-                        if "au_r" in msg[2] and msg[2]['au_r']:
-
-                            # store data from not DNNed user for merging
-                            if not topic.startswith("dnn."):
-                                if self.dnn_user_store in topic.split("."):
-                                    print("Storing data")
-                                    # store data from eye blink AUs
-                                    # user_data_au.put({k: v for k, v in au_r_sorted.items() if k in
-                                    #                  ['AU45']})
-                                    # au_data = {k: msg[2]['au_r'][k] for k in ('AU45',)}
-                                    au_data = {k: msg[2]['au_r'][k] for k in ('AU45', 'AU61', 'AU62', 'AU63', 'AU64')
-                                               if k in msg[2]['au_r']}
-                                    print(au_data)
-                                    user_data_au.put(au_data)
-                                    print("\n\n")
-
-                            # use stored data for eye blink TODO and eye gaze
-                            else:
-                                print("DNN uses stored data")
-                                # try to override AU data
-                                # msg[2]['au_r'] = {**msg[2]['au_r'], **stored_au}
-                                try:
-                                # stored_au = await user_data_au.get()
-                                    msg[2]['au_r'] = {**msg[2]['au_r'], **user_data_au.get_nowait()}
-                                except queue.Empty as e:
-                                    print("Queue empty")
-                                    print(e)
-                                    
-                                print(msg[2]['au_r'])
-                                print()
-
-                        # check head rotation dict in data and not empty
-                        if "pose" in msg[2] and msg[2]['pose']:
-                            # store data
-                            if not topic.startswith("dnn."):
-                                # from not DNNed user for merging
-                                if self.dnn_user_store in topic.split("."):
-                                    print("Storing data")
-                                    # store data from eye blink AUs
-                                    user_data_pose.put(msg[2]['pose'])
-
-                            # use stored data for head pose
-                            else:
-                                print("DNN uses stored data")
-                                try:
-                                    msg[2]['pose'] = {**msg[2]['pose'], **user_data_pose.get_nowait()}
-                                except queue.Empty as e:
-                                    print("Queue empty")
-                                    print(e)
-                                    
-                                print(msg[2]['pose'])
-                                print()
-
-                        # add target user to display data (and not display original data)
-                        msg[2]['user_ignore'] = self.dnn_user_store
-
-                        # send modified message
-                        print(msg)
-                        await self.pub_socket.send_multipart([msg[0],  # topic
-                                                              msg[1],  # timestamp
-                                                              # data in JSON format or empty byte
-                                                              json.dumps(msg[2]).encode('utf-8')
-                                                              ])
-                                                              
-                    else:
-                        print("Not enough tracking confidence to forward message")
+                    # subscription key / topic
+                    topic = msg[0].decode('ascii')
+                    timestamp = float(msg[1])
+
+                    # all participants of 1 frame; merge every participant in 1 pass with its own topic
+                    if is_bundle(msg[2]):
+                        for key, section in list(msg[2][BUNDLE_KEY].items()):
+                            if section:
+                                section = self.mix_msg(section_topic(topic, key), timestamp, section)
+                                msg[2][BUNDLE_KEY][key] = section if section is not None else ''
+                        msg[2]['user_ignore'] = self.user_ignore
+
+                    # not enough confidence to forward; empty data ('') is forwarded unchanged
+                    elif isinstance(msg[2], dict) and self.mix_msg(topic, timestamp, msg[2]) is None:
+                        continue
+
+                    # send modified message
+                    print(msg)
+                    await self.pub_socket.send_multipart([msg[0],  # topic
+                                                          msg[1],  # timestamp
+                                                          # data in JSON format or empty byte
+                                                          json.dumps(msg[2]).encode('utf-8')
+                                                          ])
 
                 # send message we're done
                 else:
@@ -183,21 +327,19 @@ class FACSvatarMessages(FACSvatarZeroMQ):
                 logging.error(traceback.format_exc())
                 print()
 
+    # user_key: participant the DNN now analyses (2 participants; other one shows it) / mixing rules as JSON
     async def set_dnn_user(self, user_key):
-        print("Was storing data for: {}".format(self.dnn_user_store))
+        print("Was mixing for: {}".format(self.user_ignore))
 
-        # store data of not DNNed user
-        if user_key == "p0":
-            user_store = "p1"
-        elif user_key == "p1":
-            user_store = "p0"
+        if user_key.startswith("{"):
+            self.set_rules(json.loads(user_key))
+        elif len(self.participants) == 2 and user_key in self.participants:
+            self.set_rules(self.default_rules([user for user in self.participants if user != user_key][0]))
         # don't change
         else:
-            user_store = self.dnn_user_store
-            print("user_key is not p0 or p1")
+            print("user_key is not 1 of 2 participants; send mixing rules (JSON) instead")
 
-        print("Now storing data for: {}".format(self.dnn_user_store))
-        self.dnn_user_store = user_store
+        print("Now mixing for: {}".format(self.user_ignore))
 
 
 if __name__ == '__main__':
@@ -220,6 +362,19 @@ if __name__ == '__main__':
     parser.add_argument("--pub_bind", default=False,
                         help="True: socket.bind() / False: socket.connect(); Default: False")
 
+    # merging
+    parser.add_argument("--participants", default="p0,p1",
+                        help="Comma separated participant keys (topic part); Default: p0,p1")
+    parser.add_argument("--mix_rules", default=argparse.SUPPRESS,
+                        help="JSON (file) per DNN participant: avatar showing DNN output and source of channels, "
+                             "e.g. {\"p0\": {\"target\": \"p1\", \"AU45\": \"p1\", \"pose\": \"p1\", "
+                             "\"gaze\": \"p1\"}}; channel: AU key / 'au' / 'pose' / 'gaze', source: participant / "
+                             "'dnn'; Default: DNN of p0 shown on p1 with blink, gaze AUs and pose of p1")
+    parser.add_argument("--buffer_size", default="120",
+                        help="Frames stored per participant used for mixing, to match DNN frames with; Default: 120")
+    parser.add_argument("--report_every", default="5",
+                        help="Seconds between printing buffer occupancy and match error; Default: 5")
+
     # router
     parser.add_argument("--rout_ip", default=argparse.SUPPRESS,
                         help="This PC's IP (e.g. 192.168.x.x) router listens to; Default: 127.0.0.1 (local)")
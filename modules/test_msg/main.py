@@ -1,29 +1,207 @@
+"""Test messages and end-to-end load generator
+
+Without --load: publish a dummy message every 100 ms and / or print received messages.
+
+With --load: synthesises AU / pose / gaze streams of N participants at x fps (procedural or looping the bundled csv
+files with jitter), publishes them into a locally launched bus --> pub_blend (--> pub_deepfacs) pipeline and measures
+end-to-end latency, throughput and dropped messages at the consumer side. Participants / fps are swept until the
+pipeline can't keep up."""
+
 # Copyright (c) Stef van der Struijk
 # License: GNU Lesser General Public License
 
 
-import os
 import sys
 import argparse
 import json
 import asyncio
 import time
+import subprocess
+from pathlib import Path
+import numpy as np
+import pandas as pd
 
 
 # own imports; if statement for documentation
 if __name__ == '__main__':
     sys.path.append("..")
+    # input_facsfromcsv imports with 'modules.' prefix
+    sys.path.append("../..")
     from facsvatarzeromq import FACSvatarZeroMQ
+    from modules.input_facsfromcsv.pub_facs import OpenFaceMessage
 else:
     from modules.facsvatarzeromq import FACSvatarZeroMQ
+    from modules.input_facsfromcsv.pub_facs import OpenFaceMessage
+
+
+MODULES_DIR = Path(__file__).resolve().parents[1]
+
+# AUs as output by OpenFace
+AU_NAMES = ['AU01', 'AU02', 'AU04', 'AU05', 'AU06', 'AU07', 'AU09', 'AU10', 'AU12', 'AU14', 'AU15', 'AU17', 'AU20',
+            'AU23', 'AU25', 'AU26', 'AU45']
+
+
+class SynthParticipant:
+    """Procedural frames of 1 participant: slowly changing expressions, blinks, head movement and saccades"""
+
+    def __init__(self, seed, fps):
+        self.rng = np.random.RandomState(seed)
+        self.fps = fps
+
+        # per AU: amplitude, frequency (Hz), phase
+        self.au_amp = self.rng.uniform(0, .6, len(AU_NAMES))
+        self.au_freq = self.rng.uniform(.05, .5, len(AU_NAMES))
+        self.au_phase = self.rng.uniform(0, 2 * np.pi, len(AU_NAMES))
+        self.blink_index = AU_NAMES.index('AU45')
+        self.next_blink = self.rng.uniform(1, 4)
+
+        # head rotation (radians)
+        self.pose_amp = self.rng.uniform(.05, .2, 3)
+        self.pose_freq = self.rng.uniform(.1, .3, 3)
+
+        # gaze jumps (saccades) between fixations
+        self.gaze = np.zeros(2)
+        self.next_saccade = 0.0
+
+    def frame(self, frame_no):
+        t = frame_no / self.fps
+
+        au_v = self.au_amp * (.5 + .5 * np.sin(2 * np.pi * self.au_freq * t + self.au_phase))
+        au_v += self.rng.normal(0, .02, len(AU_NAMES))
+
+        # blink of 150 ms every 2-6 seconds
+        if t >= self.next_blink:
+            au_v[self.blink_index] = 1.0
+            if t >= self.next_blink + .15:
+                self.next_blink = t + self.rng.uniform(2, 6)
+
+        if t >= self.next_saccade:
+            self.gaze = self.rng.uniform(-.3, .3, 2)
+            self.next_saccade = t + self.rng.uniform(.2, 1.)
+        gaze = self.gaze + self.rng.normal(0, .01, 2)
+
+        pose = self.pose_amp * np.sin(2 * np.pi * self.pose_freq * t)
+
+        return {'confidence': 0.98, 'frame': frame_no, 'timestamp': round(t, 3),
+                'au_r': dict(zip(AU_NAMES, np.clip(au_v, 0, 1).round(4).tolist())),
+                'gaze': {'gaze_angle_x': round(float(gaze[0]), 4), 'gaze_angle_y': round(float(gaze[1]), 4)},
+                'pose': dict(zip(['pose_Rx', 'pose_Ry', 'pose_Rz'], pose.round(4).tolist()))}
+
+
+class CSVParticipant:
+    """Loops the frames of a cleaned OpenFace csv; values with gaussian jitter so participants differ"""
+
+    def __init__(self, csv_path, seed, fps, jitter=.02):
+        self.rng = np.random.RandomState(seed)
+        self.fps = fps
+        self.jitter = jitter
+
+        self.rows = pd.read_csv(csv_path).to_dict('records')
+        # participants with the same csv start at a different frame
+        self.offset = self.rng.randint(len(self.rows))
+        self.ofmsg = OpenFaceMessage()
+
+    def frame(self, frame_no):
+        self.ofmsg.set_msg_row(self.rows[(frame_no + self.offset) % len(self.rows)])
+        msg = self.ofmsg.msg
+        msg['frame'] = frame_no
+        msg['timestamp'] = round(frame_no / self.fps, 3)
+
+        # low confidence frames have no data
+        if 'au_r' in msg:
+            # own noise values for AUs, pose and gaze
+            n_au, n_pose = len(msg['au_r']), len(msg['pose'])
+            noise = self.rng.normal(0, self.jitter, n_au + n_pose + len(msg.get('gaze', {})))
+            msg['au_r'] = {au: round(min(max(v + n, 0.0), 1.0), 4)
+                           for (au, v), n in zip(msg['au_r'].items(), noise[:n_au])}
+            msg['pose'] = {k: round(v + n, 4) for (k, v), n in zip(msg['pose'].items(),
+                                                                   noise[n_au:n_au + n_pose])}
+            if 'gaze' in msg:
+                msg['gaze'] = {k: round(v + n, 4) for (k, v), n in zip(msg['gaze'].items(), noise[n_au + n_pose:])}
+
+        return msg
+
+
+class Pipeline:
+    """Launches bus --> pub_blend (and pub_deepfacs) as local processes"""
+
+    def __init__(self, deepfacs=False, log_dir=None):
+        # (folder, script, arguments)
+        self.commands = [(MODULES_DIR, "n_proxy_m_bus.py", []),
+                         (MODULES_DIR / "process_facstoblend", "pub_blend.py", [])]
+        if deepfacs:
+            # DNN of p0 messages; publishes back into the bus with topic prefix 'dnn.'
+            self.commands.append((MODULES_DIR / "process_facsdnnfacs", "pub_deepfacs.py",
+                                  ["--sub_key", "openface.p0"]))
+        self.log_dir = log_dir
+        self.processes = []
+
+    def start(self):
+        for folder, script, script_args in self.commands:
+            # modules print every message; only keep output when asked
+            log = open(Path(self.log_dir) / (script[:-3] + ".log"), 'w') if self.log_dir else subprocess.DEVNULL
+            self.processes.append(subprocess.Popen([sys.executable, script] + script_args, cwd=str(folder),
+                                                   stdout=log, stderr=subprocess.STDOUT))
+            print("Started {} (pid {})".format(script, self.processes[-1].pid))
+
+    # processes that stopped (e.g. missing dependency)
+    def exited(self):
+        return [script for (_, script, _), p in zip(self.commands, self.processes) if p.poll() is not None]
+
+    def stop(self):
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            try:
+                p.wait(5)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        self.processes = []
+
+
+class LoadStats:
+    """Messages received during 1 load step"""
+
+    def __init__(self, step):
+        self.step = step
+        # topic: number of messages sent
+        self.sent = {}
+        # topic: number of messages received
+        self.received = {}
+        # latency (ms) of every received message
+        self.latency = []
+        # how late (ms) the generator sends compared to the schedule
+        self.send_lag = []
+
+    def add(self, topic, load):
+        self.received[topic] = self.received.get(topic, 0) + 1
+        self.latency.append((time.time() - load['time']) * 1000)
+
+    def report(self, participants, fps, duration, expected_dnn):
+        sent = sum(self.sent.values())
+        # DNN messages come extra for the participant it subscribes to
+        expected = sent + expected_dnn
+        received = sum(self.received.values())
+        latency = np.array(self.latency) if self.latency else np.array([np.nan])
+
+        return {'participants': participants, 'fps': fps,
+                'offered_msg_s': sent / duration, 'delivered_msg_s': received / duration,
+                'drop_rate': 1 - received / expected if expected else 0.0,
+                **{"latency_p{}_ms".format(p): float(np.percentile(latency, p)) for p in (50, 90, 99)},
+                'latency_max_ms': float(latency.max()),
+                'send_lag_p99_ms': float(np.percentile(self.send_lag, 99)) if self.send_lag else 0.0,
+                }
 
 
 # client to message broker server
 class Messages(FACSvatarZeroMQ):
     """Test class for sending / receiving messages"""
 
-    # def __init__(self, **kwargs):
-    #     super().__init__(**kwargs)
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        # statistics of current load step; None: not measuring
+        self.load_stats = None
 
     async def msg_sub(self):
         # keep listening to all published message on topic 'facs'
@@ -41,6 +219,113 @@ class Messages(FACSvatarZeroMQ):
                                                   json.dumps({'empty:': None}).encode('utf-8')
                                                   ])
 
+    # consumer side: count messages and latency of the current load step
+    async def load_sub(self):
+        while True:
+            msg = await self.sub_socket.recv_multipart()
+            if not msg[1] or self.load_stats is None:
+                continue
+
+            data = json.loads(msg[2].decode('utf-8'))
+            # messages of a previous step arriving late are ignored
+            if data and 'load' in data and data['load']['step'] == self.load_stats.step:
+                self.load_stats.add(msg[0].decode('ascii'), data['load'])
+
+    def participants(self, count, fps):
+        source = self.misc.get('source', 'synth')
+        if source == 'csv':
+            csv_list = sorted((MODULES_DIR / "input_facsfromcsv" / "openface" / "default_clean").glob("*.csv"))
+            return [CSVParticipant(csv_list[i % len(csv_list)], i, fps, float(self.misc.get('jitter', .02)))
+                    for i in range(count)]
+
+        return [SynthParticipant(i, fps) for i in range(count)]
+
+    # generator side: publish frames of all participants at fps for duration seconds
+    async def load_pub(self, step, participant_list, fps, duration):
+        time_jitter = float(self.misc.get('time_jitter', 2)) / 1000
+        rng = np.random.RandomState(step)
+        topics = ["{}.p{}.load".format(self.pub_key or "openface", i).encode('ascii')
+                  for i in range(len(participant_list))]
+
+        time_start = time.time()
+        for frame_no in range(int(duration * fps)):
+            # frames arrive with network / tracker jitter
+            time_due = time_start + frame_no / fps + rng.uniform(0, time_jitter)
+            await asyncio.sleep(max(time_due - time.time(), 0))
+            self.load_stats.send_lag.append((time.time() - time_due) * 1000)
+
+            for topic, participant in zip(topics, participant_list):
+                data = participant.frame(frame_no)
+                data['load'] = {'step': step, 'seq': frame_no, 'time': time.time()}
+                await self.pub_socket.send_multipart([topic,
+                                                      str(int(time.time() * 1000)).encode('ascii'),
+                                                      json.dumps(data).encode('utf-8')
+                                                      ])
+                self.load_stats.sent[topic] = self.load_stats.sent.get(topic, 0) + 1
+
+    # sweep number of participants and fps; stops at the first step the pipeline can't keep up
+    async def load_sweep(self):
+        participants_list = [int(p) for p in self.misc.get('participants', "1,2,4,8,16,32").split(",")]
+        fps_list = [int(f) for f in self.misc.get('fps', "30").split(",")]
+        duration = float(self.misc.get('duration', 5))
+        drain = float(self.misc.get('drain', 1))
+        max_drop = float(self.misc.get('max_drop', .01))
+        max_latency = float(self.misc.get('max_latency', 100))
+        deepfacs = self.misc.get('deepfacs', False) in (True, "True", "true", "1")
+
+        # start consumer; wait for subscriptions to reach the publishers (slow joiner)
+        asyncio.ensure_future(self.load_sub())
+        await asyncio.sleep(float(self.misc.get('startup', 3)))
+
+        print("\n{:>6} {:>4} {:>10} {:>10} {:>7} {:>8} {:>8} {:>8} {:>9}".format(
+            "users", "fps", "offer/s", "deliver/s", "drop", "p50 ms", "p90 ms", "p99 ms", "gen lag"))
+
+        results = []
+        saturated = None
+        step = 0
+        for fps in fps_list:
+            for participants in participants_list:
+                step += 1
+                self.load_stats = LoadStats(step)
+                await self.load_pub(step, self.participants(participants, fps), fps, duration)
+                # messages still in the pipeline
+                await asyncio.sleep(drain)
+
+                expected_dnn = self.load_stats.sent.get(b"openface.p0.load", 0) if deepfacs else 0
+                result = self.load_stats.report(participants, fps, duration, expected_dnn)
+                self.load_stats = None
+                result['saturated'] = result['drop_rate'] > max_drop or \
+                    not result['latency_p99_ms'] <= max_latency
+                results.append(result)
+
+                print("{participants:>6} {fps:>4} {offered_msg_s:>10.0f} {delivered_msg_s:>10.0f} {drop_rate:>6.1%} "
+                      "{latency_p50_ms:>8.1f} {latency_p90_ms:>8.1f} {latency_p99_ms:>8.1f} "
+                      "{send_lag_p99_ms:>8.1f}".format(**result) + ("  <-- saturated" if result['saturated'] else ""))
+
+                if result['saturated']:
+                    saturated = result
+                    break
+
+        # summary
+        keeps_up = [r for r in results if not r['saturated']]
+        if keeps_up:
+            best = max(keeps_up, key=lambda r: r['offered_msg_s'])
+            print("\nPipeline keeps up with {participants} participants at {fps} fps "
+                  "({offered_msg_s:.0f} msg/s, p99 {latency_p99_ms:.1f} ms)".format(**best))
+        if saturated:
+            print("Pipeline saturates at {participants} participants at {fps} fps "
+                  "(drop {drop_rate:.1%}, p99 {latency_p99_ms:.1f} ms)".format(**saturated))
+        if any(r['send_lag_p99_ms'] > 1000 / r['fps'] for r in results):
+            print("Note: generator itself couldn't keep up with its schedule; run it on another machine")
+
+        output = self.misc.get('output')
+        if output:
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2)
+            print("Results written to {}".format(output))
+
+        return results
+
 
 if __name__ == '__main__':
     # command line arguments
@@ -50,7 +335,7 @@ if __name__ == '__main__':
     parser.add_argument("--sub_ip", default=argparse.SUPPRESS,
                         help="IP (e.g. 192.168.x.x) of where to sub to; Default: 127.0.0.1 (local)")
     parser.add_argument("--sub_port", default=argparse.SUPPRESS,
-                        help="Port of where to sub to; Default: None")
+                        help="Port of where to sub to; Default: None (--load: 5572, pub_blend)")
     parser.add_argument("--sub_key", default=argparse.SUPPRESS,
                         help="Key for filtering message; Default: '' (all keys)")
     parser.add_argument("--sub_bind", default=False,
@@ -60,27 +345,81 @@ if __name__ == '__main__':
     parser.add_argument("--pub_ip", default=argparse.SUPPRESS,
                         help="IP (e.g. 192.168.x.x) of where to pub to; Default: 127.0.0.1 (local)")
     parser.add_argument("--pub_port", default=argparse.SUPPRESS,
-                        help="Port of where to pub to; Default: None")
+                        help="Port of where to pub to; Default: None (--load: 5570, bus)")
     parser.add_argument("--pub_key", default="test.pub",
-                        help="Key for filtering message; Default: blendshapes.human")
+                        help="Key for filtering message; Default: blendshapes.human (--load: openface)")
     parser.add_argument("--pub_bind", default=False,
                         help="True: socket.bind() / False: socket.connect(); Default: False")
 
+    # load generator
+    parser.add_argument("--load", default=False,
+                        help="True: run load generator / latency harness; Default: False")
+    parser.add_argument("--launch", default=True,
+                        help="--load: start bus and pub_blend locally; False: use running pipeline; Default: True")
+    parser.add_argument("--deepfacs", default=False,
+                        help="--load: also run pub_deepfacs (DNN of p0); Default: False")
+    parser.add_argument("--source", default="synth",
+                        help="--load: 'synth' (procedural) or 'csv' (loop bundled csv files); Default: synth")
+    parser.add_argument("--participants", default="1,2,4,8,16,32",
+                        help="--load: comma separated number of participants to sweep; Default: 1,2,4,8,16,32")
+    parser.add_argument("--fps", default="30",
+                        help="--load: comma separated frame rates to sweep; Default: 30")
+    parser.add_argument("--duration", default="5",
+                        help="--load: seconds per step; Default: 5")
+    parser.add_argument("--jitter", default="0.02",
+                        help="--load: std of noise added to csv values; Default: 0.02")
+    parser.add_argument("--time_jitter", default="2",
+                        help="--load: max random delay (ms) of a frame; Default: 2")
+    parser.add_argument("--drain", default="1",
+                        help="--load: seconds to wait for messages still in pipeline after a step; Default: 1")
+    parser.add_argument("--max_drop", default="0.01",
+                        help="--load: drop rate counted as saturated; Default: 0.01")
+    parser.add_argument("--max_latency", default="100",
+                        help="--load: p99 latency (ms) counted as saturated; Default: 100")
+    parser.add_argument("--startup", default="3",
+                        help="--load: seconds to wait for pipeline to start; Default: 3")
+    parser.add_argument("--log_dir", default=argparse.SUPPRESS,
+                        help="--load: folder for output of launched processes; Default: not saved")
+    parser.add_argument("--output", default=argparse.SUPPRESS,
+                        help="--load: JSON file for results; Default: not saved")
+
     args, leftovers = parser.parse_known_args()
     print("The following arguments are used: {}".format(args))
     print("The following arguments are ignored: {}\n".format(leftovers))
 
+    load = args.load in (True, "True", "true", "1")
+    pipeline = None
+    if load:
+        # publish into bus, subscribe to pub_blend
+        vars(args).setdefault('pub_port', "5570")
+        vars(args).setdefault('sub_port', "5572")
+        if args.pub_key == "test.pub":
+            args.pub_key = "openface"
+
+        if args.launch in (True, "True", "true", "1"):
+            pipeline = Pipeline(args.deepfacs in (True, "True", "true", "1"), vars(args).get('log_dir'))
+            pipeline.start()
+
     # init FACSvatar message class
     messages = Messages(**vars(args))
 
     # list of functions
     async_list = []
-    if 'sub_port' in args:
-        async_list.append(messages.msg_sub)
-    if 'pub_port' in args:
-        async_list.append(messages.msg_pub)
+    if load:
+        async_list.append(messages.load_sweep)
+    else:
+        if 'sub_port' in args:
+            async_list.append(messages.msg_sub)
+        if 'pub_port' in args:
+            async_list.append(messages.msg_pub)
 
     print("Starting functions: {}".format(async_list))
 
     # start processing messages; give list of functions to call async
-    messages.start(async_list)
+    try:
+        messages.start(async_list)
+    finally:
+        if pipeline:
+            if pipeline.exited():
+                print("Stopped early (see --log_dir): {}".format(pipeline.exited()))
+            pipeline.stop()